@@ -1,12 +1,31 @@
 import os
 import io
+import csv
 import json
+import time
+import hashlib
+import atexit
+import argparse
+import random
 import uuid
+import asyncio
 import logging
-from datetime import datetime
+import logging.handlers
+import queue
+import signal
+import functools
+import operator
+from dataclasses import dataclass, field, fields, make_dataclass
+import sqlite3
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from urllib.parse import quote
 from pytz import timezone
+import httpx
+from PIL import Image
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+    Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, InputMediaPhoto
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
@@ -14,8 +33,8 @@ from telegram.ext import (
 )
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
 from telegram.error import BadRequest
 
 
@@ -27,9 +46,39 @@ SHARED_DRIVE_ID = "0AGwYd9KBTiYXUk9PVA"
 
 SHEET_ID = "1Er9RvzWsC3nfVPUDRLo2bY0HUyuOw9davySdVT_ymUQ"
 
+# Reparto de escrituras en varias hojas (opcional). Ejemplo:
+# {"hojas": {"norte": "<sheet_id>", "sur": "<sheet_id>"}, "usuarios": {"7175478712": "norte"}}
+# Lo que no tenga ruta va a SHEET_ID ("principal").
+RUTAS_HOJAS = json.loads(os.environ.get("RUTAS_HOJAS") or "{}")
+
 USUARIOS_DEV = {7175478712,798153777}
 GRUPO_SUPERVISION_ID = [-4949670947]
 
+# Tiempo (segundos) que se espera a que lleguen todas las fotos de un álbum
+ALBUM_VENTANA_SEG = 1.0
+
+# Modo multi-proceso: N workers con conversaciones repartidas por user_id (1 = proceso único)
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+LOTE_ESCRITURA_MAX = 100  # filas por llamada a values.append en el proceso escritor
+ESPERA_CONFIRMACION_SEG = 60  # máximo que un worker espera a que el escritor confirme una fila
+IDS_GUARDADOS_MAX = 50000  # ID_REGISTRO recientes que el escritor recuerda para no duplicar reenvíos
+
+# Importación histórica (python main.py importar <archivo>)
+IMPORT_LOTE = 1000             # filas por values.append
+IMPORT_INTERVALO_SEG = 1.1     # pausa mínima entre escrituras (cuota Sheets ~60/min)
+IMPORT_SUBIDAS_PARALELAS = 8   # fotos locales subidas a la vez
+
+# Agregados para /stats (se actualizan al guardar, sin leer la hoja)
+STATS_PATH = os.environ.get("STATS_PATH", "stats_registros.sqlite3")
+
+# Cache local de fotos subidas (para /ver sin ir a Drive)
+CACHE_FOTOS_DIR = os.environ.get("CACHE_FOTOS_DIR", "cache_fotos")
+CACHE_FOTOS_MAX_MB = int(os.environ.get("CACHE_FOTOS_MAX_MB", "512"))
+
+# Índice local de hashes perceptuales para detectar fotos reutilizadas
+PHASH_DB = os.environ.get("PHASH_DB", "phash_index.sqlite3")
+PHASH_UMBRAL = 6  # distancia de Hamming máxima (bits de 64) para considerar "casi duplicado"
+
 CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON")
 
 # ================== GOOGLE SHEETS ==================
@@ -55,81 +104,254 @@ creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
 gc = gspread.authorize(creds)
 drive_service = build("drive", "v3", credentials=creds)
 
-# ================== SHEET ==================
-sh = gc.open_by_key(SHEET_ID)
-worksheet = sh.sheet1
 
-ENCABEZADOS = [
-    "FECHA", "HORA", "USER_ID", "ID_REGISTRO",
-    "TICKET", "DNI", "NOMBRE",
-    "LAT_CLIENTE", "LNG_CLIENTE","TIPO_CTO",
-    "CODIGO_CTO", "LAT_CTO", "LNG_CTO",
-    "FOTO_CTO", "SPLITTER", "PUERTO", "FOTO_SPLITTER"
-]
+# ================== GOOGLE ASYNC ==================
+class GoogleAsyncClient:
+    """Cliente asíncrono mínimo para los endpoints de Drive/Sheets que usa el bot.
+
+    Reutiliza un único pool de conexiones HTTP (sin handshakes TLS por request)
+    y comparte el token de `creds`, renovándolo antes de que expire.
+    get_or_create_folder sigue con drive_service: corre una sola vez al importar
+    el módulo, antes de que exista un event loop.
+    """
+
+    DRIVE_URL = "https://www.googleapis.com/drive/v3"
+    UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3"
+    SHEETS_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+    MARGEN_REFRESCO = timedelta(minutes=5)
+    REINTENTOS = 3
+
+    def __init__(self, credentials, max_conexiones=20):
+        self.credentials = credentials
+        self.max_conexiones = max_conexiones
+        self._client = None
+        self._lock_token = None
+
+    def _http(self):
+        # Se crea dentro del event loop en curso (run_polling crea el suyo)
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_conexiones,
+                    max_keepalive_connections=self.max_conexiones // 2,
+                ),
+            )
+            self._lock_token = asyncio.Lock()
+        return self._client
+
+    async def _token(self):
+        """Devuelve un access token vigente, refrescándolo de forma proactiva."""
+        self._http()
+        async with self._lock_token:
+            expiry = self.credentials.expiry
+            if (
+                not self.credentials.valid
+                or expiry is None
+                or expiry - datetime.utcnow() < self.MARGEN_REFRESCO
+            ):
+                # google-auth es síncrono → se refresca fuera del event loop
+                await asyncio.to_thread(self.credentials.refresh, GoogleAuthRequest())
+            return self.credentials.token
+
+    async def _request(self, method, url, idempotente=True, **kwargs):
+        """Request autenticado con reintentos.
+
+        Con idempotente=False (p. ej. values.append) solo se reintenta ante 429 o
+        si no se llegó a conectar: un 5xx puede haberse aplicado igual y
+        reintentarlo duplicaría filas.
+        """
+        headers = kwargs.pop("headers", {})
+        reintentables = (429, 500, 502, 503, 504) if idempotente else (429,)
+        for intento in range(self.REINTENTOS):
+            headers["Authorization"] = f"Bearer {await self._token()}"
+            try:
+                resp = await self._http().request(method, url, headers=headers, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # La request no llegó a enviarse → siempre es seguro reintentar
+                if intento + 1 < self.REINTENTOS:
+                    await asyncio.sleep(2 ** intento)
+                    continue
+                raise
+            if resp.status_code == 401 and intento == 0:
+                # Token revocado/expirado antes de lo previsto → forzar refresco
+                self.credentials.token = None
+                continue
+            if resp.status_code in reintentables and intento + 1 < self.REINTENTOS:
+                await asyncio.sleep(2 ** intento)
+                continue
+            resp.raise_for_status()
+            return resp
+        resp.raise_for_status()
+        return resp
+
+    async def files_create(self, metadata, data, mime_type, fields="id"):
+        """files.create con subida reanudable (uploadType=resumable)."""
+        inicio = await self._request(
+            "POST",
+            f"{self.UPLOAD_URL}/files",
+            params={"uploadType": "resumable", "supportsAllDrives": "true", "fields": fields},
+            headers={"X-Upload-Content-Type": mime_type, "X-Upload-Content-Length": str(len(data))},
+            json=metadata,
+        )
+        sesion_url = inicio.headers["Location"]
+        resp = await self._request(
+            "PUT", sesion_url, headers={"Content-Type": mime_type}, content=bytes(data)
+        )
+        return resp.json()
+
+    async def permissions_create(self, file_id, body):
+        resp = await self._request(
+            "POST",
+            f"{self.DRIVE_URL}/files/{file_id}/permissions",
+            params={"supportsAllDrives": "true"},
+            json=body,
+        )
+        return resp.json()
+
+    async def files_get_media(self, file_id):
+        """Descarga el contenido de un archivo (files.get?alt=media)."""
+        resp = await self._request(
+            "GET",
+            f"{self.DRIVE_URL}/files/{file_id}",
+            params={"alt": "media", "supportsAllDrives": "true"},
+        )
+        return resp.content
+
+    async def values_append(self, spreadsheet_id, rango, filas, value_input_option="RAW"):
+        resp = await self._request(
+            "POST",
+            f"{self.SHEETS_URL}/{spreadsheet_id}/values/{quote(rango, safe='')}:append",
+            idempotente=False,
+            params={"valueInputOption": value_input_option},
+            json={"values": filas},
+        )
+        return resp.json()
 
-if not worksheet.get_all_values():
-    worksheet.append_row(ENCABEZADOS)
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+google_async = GoogleAsyncClient(creds)
+
+# ================== VALIDADORES ==================
+# Cada validador recibe el valor crudo y devuelve el valor normalizado, o lanza
+# ValueError con el mensaje para el técnico. Los usa el bot y la importación.
+def validar_texto(valor):
+    valor = (valor or "").strip()
+    if not valor:
+        raise ValueError("⚠️ Solo se acepta texto.")
+    return valor
+
+
+def validar_ubicacion(valor):
+    try:
+        lat, lng = (float(v) for v in valor)
+    except (TypeError, ValueError):
+        raise ValueError("⚠️ Debe enviar una ubicación válida.")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("⚠️ Debe enviar una ubicación válida.")
+    return lat, lng
 
-# ================== LOGGING ==================
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
 
 # ================== PASOS ==================
+# Tabla que define el flujo completo: el orden de las claves es el orden de los
+# pasos y main() arma los estados a partir de aquí (ver MOTOR DE PASOS).
+# Las columnas de la hoja (ENCABEZADOS), los campos de Registro, el resumen, las
+# fotos a supervisión y la importación también salen de aquí.
+#   tipo: texto | ubicacion | foto | boton
+#   validar: validador propio (por defecto el del tipo)
+#   boton_corregir: texto del botón en la botonera de corrección del resumen
+#   columna: encabezado en la hoja si no es el nombre del campo
+#   resumen_junto: en el resumen, va en la misma línea que el paso anterior
+#   Pasos "ubicacion": lat_key/lng_key donde se guardan (una columna cada uno).
+#   Pasos "foto": nombre para el resumen y las fotos enviadas a supervisión.
+#   Pasos "boton": campo donde se guarda, opciones (texto, valor), si se pide
+#   confirmación, saltos (valor → paso siguiente), valor por_defecto, textos a
+#   mostrar y callback_anterior (callback_data de versiones anteriores → valor).
 PASOS = {
     "TICKET": {
         "tipo": "texto",
-        "mensaje": "🎫 Ingrese el número de TICKET:"
+        "mensaje": "🎫 Ingrese el número de TICKET:",
+        "boton_corregir": "🎫 Ticket",
     },
     "DNI": {
         "tipo": "texto",
-        "mensaje": "🪪 Ingrese el DNI del cliente:"
+        "mensaje": "🪪 Ingrese el DNI del cliente:",
+        "boton_corregir": "🪪 DNI",
     },
     "NOMBRE": {
         "tipo": "texto",
-        "mensaje": "👤 Ingrese el nombre del cliente:"
+        "mensaje": "👤 Ingrese el nombre del cliente:",
+        "boton_corregir": "👤 Nombre",
     },
     "UBICACION_CLIENTE": {
         "tipo": "ubicacion",
         "mensaje": "📍 Envíe la ubicación del cliente:",
         "lat_key": "LAT_CLIENTE",
-        "lng_key": "LNG_CLIENTE"
+        "lng_key": "LNG_CLIENTE",
+        "boton_corregir": "📍 Cliente",
     },
     "TIPO_CAJA": {
         "tipo": "boton",
         "mensaje": "🟠 Seleccione el tipo de caja que está registrando:",
+        "mensaje_corregir": "🟠 Seleccione nuevamente el tipo de caja:",
+        "campo": "TIPO_CAJA",
+        "columna": "TIPO_CTO",
+        "opciones": [("🟦 CTO", "CTO"), ("🟩 NAP", "NAP")],
+        "callback_anterior": {"TIPO_CTO": "CTO", "TIPO_NAP": "NAP"},
+        "texto_elegido": "🟠 Has seleccionado: *{}*",
+        "texto_confirmado": "✅ Tipo de caja confirmado: *{}*",
+        "boton_corregir": "🟠 Tipo de caja",
     },
     "CODIGO_CTO": {
         "tipo": "texto",
-        "mensaje": "🏷 Ingrese el código de la CTO/NAP:"
+        "mensaje": "🏷 Ingrese el código de la CTO/NAP:",
+        "boton_corregir": "🏷 CTO/NAP",
     },
     "UBICACION_CTO": {
         "tipo": "ubicacion",
         "mensaje": "📍 Envíe la ubicación de la CTO/NAP:",
         "lat_key": "LAT_CTO",
-        "lng_key": "LNG_CTO"
+        "lng_key": "LNG_CTO",
+        "boton_corregir": "📍 Ubicación CTO",
     },
     "FOTO_CTO": {
         "tipo": "foto",
-        "mensaje": "📸 Envíe la foto de la CTO o NAP:"
+        "mensaje": "📸 Envíe la foto de la CTO o NAP (puede enviar varias como álbum):",
+        "nombre": "CTO/NAP",
+        "boton_corregir": "📸 Foto CTO",
     },
     "USO_SPLITTER": {
         "tipo": "boton",
-        "mensaje": "✏️ Confirme el uso de splitter, porfavor:"
+        "mensaje": "✏️ Confirme el uso de splitter, porfavor:",
+        "campo": "SPLITTER",
+        "opciones": [("✅ Confirmar", "SI")],
+        "confirmar": False,
+        "saltos": {"NO": "RESUMEN_FINAL"},
+        "por_defecto": "NO",
+        "callback_anterior": {"SPLITTER_SI": "SI"},
+        "texto_elegido": "🔌 ¿Se confirmo el uso de splitter?: {}",
+        "visible": {"SI": "✅ Sí", "NO": "❌ No"},
     },
     "PUERTO": {
         "tipo": "texto",
-        "mensaje": "🔢 Ingrese el puerto donde se usó el splitter:"
+        "mensaje": "🔢 Ingrese el puerto donde se usó el splitter:",
+        "resumen_junto": True,
+        "boton_corregir": "🔌 Puerto",
     },
     "FOTO_SPLITTER": {
         "tipo": "foto",
-        "mensaje": "📸 Envíe la foto de CTO/NAP con splitter donde se vea el puerto:"
+        "mensaje": "📸 Envíe la foto de CTO/NAP con splitter donde se vea el puerto (puede enviar varias como álbum):",
+        "nombre": "Splitter",
+        "boton_corregir": "📸 Foto Splitter",
     },
 }
 
 PASOS_LISTA = list(PASOS.keys())
+PASOS_FOTO = [paso for paso, cfg in PASOS.items() if cfg["tipo"] == "foto"]
 
 # ================== ETIQUETAS LIMPIAS ==================
 ETIQUETAS = {
@@ -146,6 +368,591 @@ ETIQUETAS = {
     "FOTO_SPLITTER": "📸 Foto Splitter"
 }
 
+# ================== SHEET ==================
+sh = gc.open_by_key(SHEET_ID)
+worksheet = sh.sheet1
+
+
+def rango_hoja(ws):
+    return "'{}'!A1".format(ws.title.replace("'", "''"))
+
+
+def _columnas_hoja():
+    """(encabezado, campo del registro) en el orden de la hoja, a partir de PASOS."""
+    columnas = [(campo, campo) for campo in ("FECHA", "HORA", "USER_ID", "ID_REGISTRO")]
+    for paso, cfg in PASOS.items():
+        if cfg["tipo"] == "ubicacion":
+            columnas += [(cfg["lat_key"], cfg["lat_key"]), (cfg["lng_key"], cfg["lng_key"])]
+        else:
+            campo = cfg.get("campo", paso)
+            columnas.append((cfg.get("columna", campo), campo))
+    return columnas
+
+
+COLUMNAS_HOJA = _columnas_hoja()
+ENCABEZADOS = [encabezado for encabezado, _ in COLUMNAS_HOJA]
+
+
+def alinear_encabezados(ws):
+    """Posición en la hoja de cada columna de ENCABEZADOS y ancho total de la fila.
+
+    Las hojas existentes conservan su orden de columnas: si PASOS agrega un paso,
+    su columna se agrega al final del encabezado en vez de correr las demás.
+    """
+    actuales = ws.row_values(1)
+    if not actuales:
+        ws.append_row(ENCABEZADOS)
+        actuales = list(ENCABEZADOS)
+    nuevas = [c for c in ENCABEZADOS if c not in actuales]
+    if nuevas:
+        logger.warning("🧱 Hoja %s: se agregan las columnas nuevas %s al final", ws.title, nuevas)
+        if ws.col_count < len(actuales) + len(nuevas):
+            ws.add_cols(len(actuales) + len(nuevas) - ws.col_count)
+        ws.update(values=[nuevas], range_name=gspread.utils.rowcol_to_a1(1, len(actuales) + 1))
+        actuales += nuevas
+    sobrantes = [c for c in actuales if c not in ENCABEZADOS]
+    if sobrantes:
+        logger.warning("🧱 Hoja %s: columnas que ya no están en PASOS (quedan vacías): %s", ws.title, sobrantes)
+    return [actuales.index(c) for c in ENCABEZADOS], len(actuales)
+
+
+# ================== HOJAS DESTINO ==================
+class DestinoHoja:
+    """Hoja de cálculo destino con su handle gspread cacheado y su propia cola de escritura.
+
+    Las filas que llegan mientras hay una escritura en curso se agrupan en la
+    siguiente llamada a values.append, así cada hoja consume su propia cuota.
+    """
+
+    def __init__(self, nombre, sheet_id, ws=None):
+        self.nombre = nombre
+        self.sheet_id = sheet_id
+        self._worksheet = ws
+        self._posiciones = None  # índice en la hoja de cada columna de ENCABEZADOS
+        self._ancho = len(ENCABEZADOS)
+        self._cola = None
+        self._tarea = None
+
+    def worksheet(self):
+        """Handle gspread (se abre una sola vez y se alinean los encabezados)."""
+        if self._posiciones is None:
+            ws = self._worksheet or gc.open_by_key(self.sheet_id).sheet1
+            self._posiciones, self._ancho = alinear_encabezados(ws)
+            self._worksheet = ws
+        return self._worksheet
+
+    def a_hoja(self, fila):
+        """Fila en orden de ENCABEZADOS → orden de columnas de esta hoja."""
+        salida = [""] * self._ancho
+        for valor, posicion in zip(fila, self._posiciones):
+            salida[posicion] = valor
+        return salida
+
+    def de_hoja(self, fila):
+        """Fila leída de esta hoja → orden de ENCABEZADOS."""
+        return [fila[posicion] if posicion < len(fila) else "" for posicion in self._posiciones]
+
+    async def escribir(self, filas):
+        """Encola las filas y espera a que queden escritas."""
+        if self._cola is None:
+            self._cola = asyncio.Queue()
+            self._tarea = asyncio.create_task(self._escritor())
+        listo = asyncio.get_running_loop().create_future()
+        await self._cola.put((filas, listo))
+        await listo
+
+    async def _escritor(self):
+        rango = None
+        while True:
+            lote = [await self._cola.get()]
+            total = len(lote[0][0])
+            while not self._cola.empty() and total < LOTE_ESCRITURA_MAX:
+                lote.append(self._cola.get_nowait())
+                total += len(lote[-1][0])
+            try:
+                if rango is None:
+                    rango = rango_hoja(await asyncio.to_thread(self.worksheet))
+                await google_async.values_append(
+                    self.sheet_id, rango, [self.a_hoja(fila) for filas, _ in lote for fila in filas]
+                )
+            except Exception as e:
+                for _, listo in lote:
+                    if not listo.done():
+                        listo.set_exception(e)
+            else:
+                for _, listo in lote:
+                    if not listo.done():
+                        listo.set_result(None)
+
+    def leer(self):
+        """Filas de datos (sin encabezado), en el orden de ENCABEZADOS."""
+        return [self.de_hoja(fila) for fila in self.worksheet().get_all_values()[1:]]
+
+
+DESTINOS = {"principal": DestinoHoja("principal", SHEET_ID, worksheet)}
+for _nombre, _sheet_id in RUTAS_HOJAS.get("hojas", {}).items():
+    DESTINOS[_nombre] = DestinoHoja(_nombre, _sheet_id)
+
+DESTINO_POR_USUARIO = {}
+for _user_id, _nombre in RUTAS_HOJAS.get("usuarios", {}).items():
+    if _nombre not in DESTINOS:
+        raise RuntimeError(f"❌ RUTAS_HOJAS: el usuario {_user_id} apunta a una hoja desconocida: {_nombre}")
+    DESTINO_POR_USUARIO[str(_user_id)] = _nombre
+
+_IDX_USER_ID = ENCABEZADOS.index("USER_ID")
+_IDX_ID_REGISTRO = ENCABEZADOS.index("ID_REGISTRO")
+
+
+def leer_todas_las_hojas():
+    """Vista combinada (sin encabezados) de todas las hojas destino, para exportar."""
+    return [fila for destino in DESTINOS.values() for fila in destino.leer()]
+
+
+def preparar_hojas():
+    """Abre todas las hojas destino al arrancar y alinea sus encabezados con PASOS."""
+    for destino in DESTINOS.values():
+        destino.worksheet()
+
+# ================== LOGGING ==================
+# Fracción (0..1) de logs de paso (alto volumen) que se conservan
+LOG_MUESTREO_PASOS = float(os.environ.get("LOG_MUESTREO_PASOS", "1.0"))
+
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por log, con el contexto del registro si viene en `extra`."""
+
+    CAMPOS_CONTEXTO = ("ID_REGISTRO", "USER_ID", "PASO_ACTUAL")
+
+    def format(self, record):
+        datos = {
+            "ts": self.formatTime(record),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for campo in self.CAMPOS_CONTEXTO:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                datos[campo] = valor
+        if record.exc_info:
+            datos["exc"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class MuestreoPasos(logging.Filter):
+    """Descarta una fracción de los logs marcados con extra={"muestreo": True}."""
+
+    def __init__(self, tasa):
+        super().__init__()
+        self.tasa = tasa
+
+    def filter(self, record):
+        return not getattr(record, "muestreo", False) or random.random() < self.tasa
+
+
+class ColaLogHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no formatea en el hilo que loguea.
+
+    El QueueHandler estándar arma el mensaje en prepare(); aquí el record se
+    encola tal cual y el formateo (incluido JSON) ocurre en el hilo del listener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+_cola_logs = queue.SimpleQueue()
+_handler_salida = logging.StreamHandler()
+_handler_salida.setFormatter(FormatoJSON())
+_handler_cola = ColaLogHandler(_cola_logs)
+_handler_cola.addFilter(MuestreoPasos(LOG_MUESTREO_PASOS))
+logging.basicConfig(level=logging.INFO, handlers=[_handler_cola])
+_listener_logs = logging.handlers.QueueListener(_cola_logs, _handler_salida)
+_listener_logs.start()
+atexit.register(_listener_logs.stop)
+
+logger = logging.getLogger(__name__)
+
+
+def ctx_log(registro, muestreo=False):
+    """`extra` para logger con la traza del registro (ID_REGISTRO, USER_ID, PASO_ACTUAL)."""
+    return {
+        "ID_REGISTRO": registro.ID_REGISTRO,
+        "USER_ID": registro.USER_ID,
+        "PASO_ACTUAL": registro.PASO_ACTUAL,
+        "muestreo": muestreo,
+    }
+
+# ================== REGISTRO ==================
+@dataclass(slots=True)
+class _EstadoRegistro:
+    """Estado de la conversación y métodos comunes de Registro."""
+
+    ACTIVO: bool = True
+    PASO_ACTUAL: str = PASOS_LISTA[0]
+    CORRIGIENDO: str | None = None
+    DESDE_RESUMEN: bool = False
+    CORRIGIENDO_ULTIMO: str | None = None
+    VERSION: int = 0
+    PHASHES: dict[str, list[tuple[int, str]]] = field(default_factory=dict)  # se indexan al guardar
+    FOTOS_REPETIDAS: dict[str, list[tuple[str, str]]] = field(default_factory=dict)  # paso → [(ticket, fecha)]
+    # --- Transitorio (no se serializa) ---
+    RESUMEN_CACHE: dict[str, object] | None = None
+
+    def marcar_cambio(self):
+        """Incrementa la versión (invalida el resumen cacheado)."""
+        self.VERSION += 1
+
+    def empaquetar(self):
+        """(nombres, valores) de los campos persistentes.
+
+        Los nombres van junto a los valores porque los campos salen de PASOS: un
+        registro guardado antes de agregar o quitar un paso se recupera por nombre.
+        (pickle guarda la tupla de nombres una sola vez por archivo.)
+        """
+        return CAMPOS_PERSISTENTES, tuple(
+            tuple(valor) if isinstance(valor, list) else valor
+            for valor in _LEER_PERSISTENTES(self)
+        )
+
+    @classmethod
+    def desempaquetar(cls, paquete):
+        nombres, valores = paquete
+        registro = cls()
+        for nombre, valor in zip(nombres, valores):
+            if nombre in CAMPOS_PERSISTENTES:  # campos de pasos que ya no existen se descartan
+                setattr(registro, nombre, list(valor) if isinstance(valor, tuple) else valor)
+        return registro
+
+    def __reduce__(self):
+        # pickle (p. ej. PicklePersistence) guarda solo la tupla empaquetada
+        return (type(self).desempaquetar, (self.empaquetar(),))
+
+
+def _campos_registro():
+    """(nombre, tipo, valor por defecto) de cada columna de la hoja, según su paso."""
+    por_campo = {"USER_ID": (int | str, "")}
+    for paso, cfg in PASOS.items():
+        if cfg["tipo"] == "ubicacion":
+            por_campo[cfg["lat_key"]] = por_campo[cfg["lng_key"]] = (float | None, None)
+        elif cfg["tipo"] == "foto":
+            por_campo[paso] = (list[str], field(default_factory=list))
+        elif cfg["tipo"] == "boton":
+            por_campo[cfg["campo"]] = (str, cfg.get("por_defecto", ""))
+    return [(campo, *por_campo.get(campo, (str, ""))) for _, campo in COLUMNAS_HOJA]
+
+
+# Los campos de datos se generan desde COLUMNAS_HOJA (es decir, desde PASOS):
+# un paso nuevo tiene su campo sin tocar esta clase.
+Registro = make_dataclass(
+    "Registro",
+    _campos_registro(),
+    bases=(_EstadoRegistro,),
+    slots=True,
+    namespace={
+        "__module__": __name__,
+        "__doc__": """Registro en curso de un técnico (se guarda en context.user_data["registro"]).
+
+    Los campos de datos se llaman igual que las claves de PASOS/ENCABEZADOS para
+    poder leerlos y escribirlos por nombre de paso (getattr/setattr). VERSION se
+    incrementa con marcar_cambio() en cada modificación de datos.
+    """,
+    },
+)
+
+
+CAMPOS_PERSISTENTES = tuple(f.name for f in fields(Registro) if f.name != "RESUMEN_CACHE")
+_LEER_PERSISTENTES = operator.attrgetter(*CAMPOS_PERSISTENTES)
+
+# Campos del registro en el orden de la fila (ver COLUMNAS_HOJA)
+_CAMPOS_FILA = tuple(campo for _, campo in COLUMNAS_HOJA)
+_LEER_FILA = operator.attrgetter(*_CAMPOS_FILA)
+_IDX_FOTOS_FILA = tuple(i for i, campo in enumerate(_CAMPOS_FILA) if campo in PASOS_FOTO)
+
+
+def construir_fila(registro):
+    """Fila para la hoja en el orden de ENCABEZADOS."""
+    fila = ["" if valor is None else valor for valor in _LEER_FILA(registro)]
+    for i in _IDX_FOTOS_FILA:
+        fila[i] = "\n".join(fila[i])  # Links Drive, uno por línea
+    return fila
+
+
+def fotos_registro(registro):
+    """{paso: [links]} de los pasos de foto del registro."""
+    return {paso: getattr(registro, paso) for paso in PASOS_FOTO}
+
+
+# ================== RENDER DE RESÚMENES ==================
+# Markdown "legacy" de Telegram: estos caracteres del usuario rompen el parseo
+_ESCAPE_MD = str.maketrans({c: "\\" + c for c in "_*`["})
+
+ENCABEZADO_RESUMEN = "📋 *Resumen del registro*\n\n"
+ENCABEZADO_GUARDADO = "✅ *Registro guardado exitosamente*\n\n"
+
+
+def escapar_md(valor):
+    """Escapa texto libre para enviarlo con parse_mode="Markdown"."""
+    return str(valor).translate(_ESCAPE_MD)
+
+
+def _compilar_plantilla_resumen():
+    """Arma una sola vez la plantilla del resumen a partir de PASOS y ETIQUETAS."""
+    lineas = []
+    for paso, cfg in PASOS.items():
+        if cfg["tipo"] == "foto":
+            continue  # todas van juntas en la línea de fotos
+        campo = cfg.get("campo", paso)
+        linea = f"{escapar_md(ETIQUETAS.get(campo, campo))}: {{{paso}}}"
+        if cfg.get("resumen_junto") and lineas:
+            lineas[-1] += " | " + linea
+        else:
+            lineas.append(linea)
+    lineas.append("📸 Fotos: {FOTOS}")
+    return "\n".join(lineas)
+
+
+PLANTILLA_RESUMEN = _compilar_plantilla_resumen()
+
+
+def _coordenadas(registro, lat_key, lng_key):
+    lat, lng = getattr(registro, lat_key), getattr(registro, lng_key)
+    return f"({lat}, {lng})" if lat is not None and lng is not None else "-"
+
+
+def _estado_fotos(registro, campo, nombre):
+    cantidad = len(getattr(registro, campo))
+    if not cantidad:
+        return f"❌ {nombre}"
+    return f"✅ {nombre}" if cantidad == 1 else f"✅ {nombre} ({cantidad})"
+
+
+def render_resumen(registro, encabezado=ENCABEZADO_RESUMEN):
+    """Texto del resumen (Markdown escapado), cacheado por versión del registro.
+
+    La versión se incrementa con marcar_cambio(); mientras no cambie, volver a
+    mostrar el resumen (p. ej. durante correcciones) reutiliza el texto ya armado.
+    """
+    cache = registro.RESUMEN_CACHE
+    if cache is None or cache["VERSION"] != registro.VERSION:
+        cache = registro.RESUMEN_CACHE = {"VERSION": registro.VERSION}
+    if encabezado not in cache:
+        valores = {}
+        for paso, cfg in PASOS.items():
+            if cfg["tipo"] == "ubicacion":
+                valores[paso] = _coordenadas(registro, cfg["lat_key"], cfg["lng_key"])
+            elif cfg["tipo"] != "foto":
+                valores[paso] = escapar_md(getattr(registro, cfg.get("campo", paso)) or "-")
+        valores["FOTOS"] = " | ".join(_estado_fotos(registro, paso, PASOS[paso]["nombre"]) for paso in PASOS_FOTO)
+        cache[encabezado] = encabezado + PLANTILLA_RESUMEN.format_map(valores) + _avisos_repetidas(registro)
+    return cache[encabezado]
+
+
+def _avisos_repetidas(registro):
+    """Líneas de aviso por fotos casi iguales a las de otros registros (también van a supervisión)."""
+    return "".join(
+        f"\n⚠️ Posible foto repetida ({PASOS[paso]['nombre']}): "
+        f"se parece a una del ticket {escapar_md(ticket)} ({escapar_md(fecha)})"
+        for paso, repetidas in registro.FOTOS_REPETIDAS.items() for ticket, fecha in repetidas
+    )
+
+
+# ================== ÍNDICE PHASH ==================
+def calcular_dhash(file_bytes):
+    """dHash de 64 bits: compara el brillo de píxeles vecinos en una miniatura 9x8."""
+    with Image.open(io.BytesIO(file_bytes)) as img:
+        pixeles = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    valor = 0
+    for fila in range(8):
+        for col in range(8):
+            izq = pixeles[fila * 9 + col]
+            der = pixeles[fila * 9 + col + 1]
+            valor = (valor << 1) | (izq > der)
+    return valor
+
+
+class IndicePHash:
+    """Índice local (SQLite) de hashes perceptuales con búsqueda por distancia de Hamming.
+
+    Usa multi-index hashing: el hash de 64 bits se parte en 4 bandas de 16 bits
+    indexadas. Si dos hashes están a distancia <= 7, por el principio del palomar
+    al menos una banda difiere en <= 1 bit, así que basta consultar cada banda
+    exacta y sus 16 vecinas a 1 bit (lookups indexados, sin recorrer la tabla).
+    """
+
+    BANDAS = 4
+    BITS_BANDA = 16
+    MAX_DISTANCIA = 7
+
+    def __init__(self, ruta):
+        self._conn = sqlite3.connect(ruta, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fotos_phash ("
+                " hash INTEGER NOT NULL, b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER,"
+                " id_registro TEXT, ticket TEXT, paso TEXT, link TEXT, fecha TEXT)"
+            )
+            for i in range(self.BANDAS):
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_phash_b{i} ON fotos_phash (b{i})")
+
+    @classmethod
+    def _bandas(cls, valor):
+        mascara = (1 << cls.BITS_BANDA) - 1
+        return [(valor >> (i * cls.BITS_BANDA)) & mascara for i in range(cls.BANDAS)]
+
+    @staticmethod
+    def _a_sqlite(valor):
+        # SQLite guarda enteros con signo de 64 bits
+        return valor - (1 << 64) if valor >= 1 << 63 else valor
+
+    def buscar(self, valor, max_distancia=PHASH_UMBRAL, excluir_registro=None):
+        """Devuelve [(distancia, fila)] de fotos a <= max_distancia bits, de la más parecida a la menos."""
+        max_distancia = min(max_distancia, self.MAX_DISTANCIA)
+        candidatos = {}
+        with self._lock:
+            for i, banda in enumerate(self._bandas(valor)):
+                vecinas = [banda] + [banda ^ (1 << bit) for bit in range(self.BITS_BANDA)]
+                marcas = ",".join("?" * len(vecinas))
+                filas = self._conn.execute(
+                    f"SELECT rowid, hash, id_registro, ticket, paso, link, fecha"
+                    f" FROM fotos_phash WHERE b{i} IN ({marcas})",
+                    vecinas,
+                )
+                for rowid, *fila in filas:
+                    candidatos[rowid] = fila
+
+        resultados = []
+        for guardado, id_registro, ticket, paso, link, fecha in candidatos.values():
+            if excluir_registro and id_registro == excluir_registro:
+                continue
+            distancia = ((guardado & ((1 << 64) - 1)) ^ valor).bit_count()
+            if distancia <= max_distancia:
+                resultados.append((distancia, {
+                    "ID_REGISTRO": id_registro, "TICKET": ticket,
+                    "PASO": paso, "LINK": link, "FECHA": fecha,
+                }))
+        resultados.sort(key=lambda r: r[0])
+        return resultados
+
+    def agregar(self, filas):
+        """Agrega [(hash, id_registro, ticket, paso, link, fecha)] en una sola transacción."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO fotos_phash (hash, b0, b1, b2, b3, id_registro, ticket, paso, link, fecha)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [[self._a_sqlite(valor), *self._bandas(valor), *resto] for valor, *resto in filas],
+            )
+
+
+indice_phash = IndicePHash(PHASH_DB)
+
+
+# ================== CACHE DE FOTOS ==================
+class CacheFotos:
+    """Cache en disco de fotos, direccionada por contenido (sha256), con desalojo LRU.
+
+    Las fotos se guardan como <carpeta>/<sha[:2]>/<sha>.jpg. Un índice SQLite en
+    la misma carpeta relaciona file_id de Drive → sha y ticket → fotos, y lleva el
+    último acceso de cada archivo para desalojar los menos usados cuando se
+    supera el tamaño máximo. Al ser SQLite + archivos, la comparten los workers.
+    """
+
+    def __init__(self, carpeta, max_bytes):
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+        os.makedirs(carpeta, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(carpeta, "indice.sqlite3"), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, tamano INTEGER, ultimo_acceso REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_acceso ON blobs (ultimo_acceso)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS archivos (file_id TEXT PRIMARY KEY, sha TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tickets (ticket TEXT, paso TEXT, file_id TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_ticket ON tickets (ticket)")
+
+    def _ruta(self, sha):
+        return os.path.join(self.carpeta, sha[:2], f"{sha}.jpg")
+
+    def guardar(self, file_bytes, file_id):
+        """Guarda la foto (si no estaba) y la asocia al file_id de Drive."""
+        sha = hashlib.sha256(file_bytes).hexdigest()
+        ruta = self._ruta(sha)
+        if not os.path.exists(ruta):
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            tmp = f"{ruta}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(file_bytes)
+            os.replace(tmp, ruta)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs (sha, tamano, ultimo_acceso) VALUES (?, ?, ?)",
+                (sha, len(file_bytes), time.time()),
+            )
+            self._conn.execute("INSERT OR REPLACE INTO archivos (file_id, sha) VALUES (?, ?)", (file_id, sha))
+            self._desalojar()
+        return sha
+
+    def leer(self, file_id):
+        """Bytes de la foto si está en cache (y la marca como usada); None si no."""
+        with self._lock:
+            fila = self._conn.execute("SELECT sha FROM archivos WHERE file_id = ?", (file_id,)).fetchone()
+        if not fila:
+            return None
+        try:
+            with open(self._ruta(fila[0]), "rb") as f:
+                file_bytes = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE blobs SET ultimo_acceso = ? WHERE sha = ?", (time.time(), fila[0]))
+        return file_bytes
+
+    def _desalojar(self):
+        # Se llama con el lock tomado y dentro de la transacción
+        total = self._conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for sha, tamano in self._conn.execute(
+            "SELECT sha, tamano FROM blobs ORDER BY ultimo_acceso"
+        ).fetchall():
+            try:
+                os.remove(self._ruta(sha))
+            except FileNotFoundError:
+                pass
+            self._conn.execute("DELETE FROM blobs WHERE sha = ?", (sha,))
+            total -= tamano
+            if total <= self.max_bytes:
+                break
+
+    def asociar_ticket(self, ticket, fotos):
+        """Registra las fotos ({paso: [links]}) de un ticket guardado."""
+        filas = [
+            (str(ticket).strip(), paso, file_id_de_link(link))
+            for paso, links in fotos.items() for link in links
+            if "id=" in link  # solo links de Drive
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO tickets (ticket, paso, file_id) VALUES (?, ?, ?)", filas)
+
+    def fotos_ticket(self, ticket):
+        """[(paso, file_id)] de un ticket, en el orden en que se guardaron."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT paso, file_id FROM tickets WHERE ticket = ? ORDER BY rowid", (str(ticket).strip(),)
+            ).fetchall()
+
+
+def file_id_de_link(link):
+    """file_id de Drive a partir del link uc?id= que genera upload_to_drive."""
+    return link.rsplit("id=", 1)[-1]
+
+
+cache_fotos = CacheFotos(CACHE_FOTOS_DIR, CACHE_FOTOS_MAX_MB * 1024 * 1024)
 
 # ========= CREAR CARPETA ========
 
@@ -186,29 +993,58 @@ def get_fecha_hora():
     return now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")
 
 
-def upload_to_drive(file_bytes, filename, mime_type="image/jpeg"):
+async def upload_to_drive(file_bytes, filename, mime_type="image/jpeg"):
     """Sube un archivo a la carpeta IMAGENES_SPLITTERS en el Drive compartido y devuelve el link público."""
-    media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type, resumable=True)
     file_metadata = {"name": filename, "parents": [CARPETA_IMAGENES_ID]}
-    
-    file = drive_service.files().create(
-        body=file_metadata,
-        media_body=media,
-        fields="id",
-        supportsAllDrives=True
-    ).execute()
+
+    file = await google_async.files_create(file_metadata, file_bytes, mime_type)
 
     file_id = file.get("id")
 
     # Dar permisos de lectura pública
-    drive_service.permissions().create(
-        fileId=file_id,
-        body={"role": "reader", "type": "anyone"},
-        supportsAllDrives=True
-    ).execute()
+    await google_async.permissions_create(file_id, {"role": "reader", "type": "anyone"})
 
     return f"https://drive.google.com/uc?id={file_id}"
 
+async def indexar_foto(file_bytes, registro, paso, link):
+    """Calcula el pHash fuera del event loop, lo anota en el registro y devuelve fotos casi duplicadas.
+
+    El hash entra al índice recién al guardar el registro (registrar_phashes), así
+    las fotos de un registro cancelado no generan avisos falsos al repetirlo.
+    """
+    try:
+        valor = await asyncio.to_thread(calcular_dhash, bytes(file_bytes))
+    except Exception as e:
+        logger.warning("⚠️ No se pudo calcular el pHash de %s: %s", paso, e, extra=ctx_log(registro))
+        return []
+    # Imágenes casi planas (negras, blancas) dan hashes degenerados que "coinciden" entre sí
+    if not 4 <= valor.bit_count() <= 60:
+        return []
+    registro.PHASHES.setdefault(paso, []).append((valor, link))
+    return await asyncio.to_thread(indice_phash.buscar, valor, excluir_registro=registro.ID_REGISTRO)
+
+
+def registrar_phashes(registro):
+    """Agrega al índice los pHash de un registro ya guardado."""
+    indice_phash.agregar([
+        (valor, registro.ID_REGISTRO, registro.TICKET, paso, link, registro.FECHA)
+        for paso, hashes in registro.PHASHES.items() for valor, link in hashes
+    ])
+
+
+async def subir_foto(photo, filename, registro, paso):
+    """Descarga una foto de Telegram, la sube a Drive y la indexa.
+
+    Devuelve el link público y la lista de fotos previas casi idénticas.
+    """
+    file = await photo.get_file()
+    file_bytes = await file.download_as_bytearray()
+    link = await upload_to_drive(file_bytes, filename)
+    await asyncio.to_thread(cache_fotos.guardar, bytes(file_bytes), file_id_de_link(link))
+    similares = await indexar_foto(file_bytes, registro, paso, link)
+    return link, similares
+
+
 # ========= CREAR CARPETAS EN DRIVE =========
 CARPETA_BASE_ID = get_or_create_folder("REPORTE_SPLITTERS_SGA", parent_id=SHARED_DRIVE_ID)
 CARPETA_IMAGENES_ID = get_or_create_folder("IMAGENES_SPLITTERS", parent_id=CARPETA_BASE_ID)
@@ -220,11 +1056,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_id in GRUPO_SUPERVISION_ID:
         return ConversationHandler.END
 
-    registro = context.user_data.get("registro", {})
+    registro = context.user_data.get("registro")
 
-    if registro.get("ACTIVO", False):
+    if registro is not None and registro.ACTIVO:
         # ⚠️ Registro activo → comportarse como /registro
-        paso_actual = registro.get("PASO_ACTUAL", "TICKET")
+        paso_actual = registro.PASO_ACTUAL
         await update.message.reply_text(
             f"⚠️ Ya tienes un registro en curso.\n\n"
             f"📌 Estás en el paso: *{ETIQUETAS.get(paso_actual, paso_actual)}*.\n\n"
@@ -253,9 +1089,9 @@ async def registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # 🚫 Si ya tiene un registro activo
-    if "registro" in context.user_data and context.user_data["registro"].get("ACTIVO", False):
-        registro = context.user_data["registro"]
-        paso_actual = registro.get("PASO_ACTUAL", "TICKET")
+    registro = context.user_data.get("registro")
+    if registro is not None and registro.ACTIVO:
+        paso_actual = registro.PASO_ACTUAL
         await update.message.reply_text(
             f"⚠️ Ya tienes un registro en curso.\n\n"
             f"📌 Estás en el paso: *{ETIQUETAS.get(paso_actual, paso_actual)}*.\n\n"
@@ -265,12 +1101,11 @@ async def registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return paso_actual
 
     # ✅ Crear nuevo registro
-    context.user_data["registro"] = {
-        "USER_ID": user_id,
-        "ID_REGISTRO": str(uuid.uuid4())[:8],
-        "ACTIVO": True,
-        "PASO_ACTUAL": "TICKET"  # 👈 añadimos esto para que /start sepa en qué paso estamos
-    }
+    context.user_data["registro"] = Registro(
+        USER_ID=user_id,
+        ID_REGISTRO=str(uuid.uuid4())[:8],
+        PASO_ACTUAL="TICKET"  # 👈 para que /start sepa en qué paso estamos
+    )
     await update.message.reply_text(PASOS["TICKET"]["mensaje"])
     return "TICKET"
 
@@ -280,8 +1115,8 @@ async def registro_activo_callback(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
 
     if query.data == "CONTINUAR_REGISTRO":
-        registro = context.user_data.get("registro", {})
-        paso_actual = registro.get("PASO_ACTUAL", "TICKET")
+        registro = context.user_data.get("registro")
+        paso_actual = registro.PASO_ACTUAL if registro else "TICKET"
         await query.edit_message_text(f"✅ Continuando desde {paso_actual}...")
         await context.bot.send_message(query.message.chat.id, PASOS[paso_actual]["mensaje"])
         return paso_actual
@@ -292,198 +1127,329 @@ async def registro_activo_callback(update: Update, context: ContextTypes.DEFAULT
         return ConversationHandler.END
 
 
-# ================== HANDLER GENÉRICO ==================
-async def manejar_paso(update: Update, context: ContextTypes.DEFAULT_TYPE, paso: str):
-    chat_id = update.effective_chat.id
-    if chat_id in GRUPO_SUPERVISION_ID:
+# ================== MOTOR DE PASOS ==================
+# Tablas precalculadas a partir de PASOS: transiciones, validadores y teclados.
+# Agregar un paso es agregar una entrada en PASOS; no hace falta código nuevo.
+VALIDADOR_POR_TIPO = {"texto": validar_texto, "ubicacion": validar_ubicacion}
+
+VALIDADORES = {
+    paso: cfg.get("validar", VALIDADOR_POR_TIPO.get(cfg["tipo"]))
+    for paso, cfg in PASOS.items()
+}
+
+SIGUIENTE_PASO = {
+    paso: PASOS_LISTA[i + 1] if i + 1 < len(PASOS_LISTA) else "RESUMEN_FINAL"
+    for i, paso in enumerate(PASOS_LISTA)
+}
+
+# Valores aceptados por cada paso de botones (opciones + valores con salto propio)
+VALORES_BOTON = {
+    paso: {valor for _, valor in cfg["opciones"]} | set(cfg.get("saltos", {}))
+    for paso, cfg in PASOS.items() if cfg["tipo"] == "boton"
+}
+
+TECLADO_OPCIONES = {
+    paso: InlineKeyboardMarkup([[
+        InlineKeyboardButton(texto, callback_data=f"{paso}:{valor}") for texto, valor in cfg["opciones"]
+    ]])
+    for paso, cfg in PASOS.items() if cfg["tipo"] == "boton"
+}
+
+TECLADO_CONFIRMAR = {
+    paso: InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
+        InlineKeyboardButton("✏️ Corregir", callback_data=f"CORREGIR_{paso}"),
+    ]])
+    for paso in PASOS
+}
+
+_BOTONES_CORREGIR = [
+    InlineKeyboardButton(cfg["boton_corregir"], callback_data=f"CORREGIR_{paso}")
+    for paso, cfg in PASOS.items() if "boton_corregir" in cfg
+]
+TECLADO_CORREGIR_CAMPO = InlineKeyboardMarkup(
+    [_BOTONES_CORREGIR[i:i + 2] for i in range(0, len(_BOTONES_CORREGIR), 2)]
+)
+
+
+async def editar_mensaje(query, texto, **kwargs):
+    """edit_message_text ignorando el error de 'mensaje sin cambios'."""
+    try:
+        await query.edit_message_text(texto, **kwargs)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+
+
+async def pedir_paso(bot, chat_id, paso):
+    """Envía la pregunta de un paso (con su botonera si es de botones)."""
+    await bot.send_message(chat_id, PASOS[paso]["mensaje"], reply_markup=TECLADO_OPCIONES.get(paso))
+    return paso
+
+
+async def pedir_correccion(query, paso):
+    """Reemplaza el mensaje actual por la pregunta del paso a corregir."""
+    cfg = PASOS.get(paso)
+    if cfg is None:
+        await editar_mensaje(query, f"✏️ Ingresa el valor para {ETIQUETAS.get(paso, paso)}:")
+    elif cfg["tipo"] == "boton":
+        await editar_mensaje(
+            query, cfg.get("mensaje_corregir", cfg["mensaje"]), reply_markup=TECLADO_OPCIONES[paso]
+        )
+    else:
+        await editar_mensaje(query, cfg["mensaje"])
+    return paso
+
+
+# --- Lectores por tipo de entrada: guardan el valor y devuelven el texto visible ---
+async def leer_texto(update, context, registro, paso):
+    valor = VALIDADORES[paso](update.message.text)
+    setattr(registro, paso, valor)
+    return valor
+
+
+async def leer_ubicacion(update, context, registro, paso):
+    cfg = PASOS[paso]
+    location = update.message.location
+    if not location:
+        raise ValueError("⚠️ Debe enviar una ubicación válida.")
+    lat, lng = VALIDADORES[paso]((location.latitude, location.longitude))
+    setattr(registro, cfg["lat_key"], lat)
+    setattr(registro, cfg["lng_key"], lng)
+    return f"({lat}, {lng})"
+
+
+async def leer_foto(update, context, registro, paso):
+    if not update.message.photo:
+        raise ValueError("⚠️ Debe enviar una foto.")
+    fotos = [update.message.photo[-1]]
+
+    # 📚 Álbum: Telegram envía cada foto como un update separado con el mismo
+    # media_group_id. Las siguientes llegan por acumular_album (estado WAITING) y
+    # pueden llegar antes de que esta tarea empiece: se juntan en un buffer por
+    # media_group_id que aquí se completa hasta que deja de crecer.
+    media_group_id = update.message.media_group_id
+    albumes = context.user_data.setdefault("ALBUMES", {})
+    for cerrado in [mgid for mgid, album in albumes.items() if not album["ABIERTO"]]:
+        del albumes[cerrado]  # álbumes de pasos anteriores
+    if media_group_id:
+        album = albumes.setdefault(media_group_id, {"FOTOS": [], "ABIERTO": True})
+        album["FOTOS"].insert(0, fotos[0])
+        while True:
+            recibidas = len(album["FOTOS"])
+            await asyncio.sleep(ALBUM_VENTANA_SEG)
+            if len(album["FOTOS"]) == recibidas:
+                break
+        album["ABIERTO"] = False  # las que lleguen ahora se avisan como tardías
+        fotos = album["FOTOS"]
+
+    # ⬆️ Subidas en paralelo
+    registro.PHASHES[paso] = []  # al corregir, los hashes de las fotos anteriores ya no valen
+    base = f"{paso}_{registro.ID_REGISTRO}"
+    nombres = [f"{base}.jpg"] if len(fotos) == 1 else [f"{base}_{i}.jpg" for i in range(1, len(fotos) + 1)]
+    subidas = await asyncio.gather(*(subir_foto(f, n, registro, paso) for f, n in zip(fotos, nombres)))
+    setattr(registro, paso, [link for link, _ in subidas])
+
+    # Fotos de otro álbum enviado mientras se procesaba este: no se usan
+    ignoradas = 0
+    for otro in [mgid for mgid, album in albumes.items() if album["ABIERTO"]]:
+        ignoradas += len(albumes.pop(otro)["FOTOS"])
+
+    cantidad = len(fotos)
+    visible = (
+        "📸 Foto recibida correctamente" if cantidad == 1
+        else f"📸 {cantidad} fotos recibidas correctamente"
+    )
+    if ignoradas:
+        visible += f"\n⚠️ Se ignoraron {ignoradas} fotos de otro álbum enviado mientras se procesaba este."
+    # 🔎 Aviso de posible foto reutilizada de otro registro (queda en el registro
+    # para el resumen y para supervisión, también si se corrige desde el resumen)
+    registro.FOTOS_REPETIDAS.pop(paso, None)
+    for distancia, previa in (similares[0] for _, similares in subidas if similares):
+        logger.warning(
+            "🔁 Posible foto repetida en %s: similar a %s (distancia %s)",
+            paso, previa["ID_REGISTRO"], distancia, extra=ctx_log(registro)
+        )
+        registro.FOTOS_REPETIDAS.setdefault(paso, []).append((previa["TICKET"] or "-", previa["FECHA"]))
+        visible += (
+            f"\n⚠️ Posible foto repetida: se parece a una foto del ticket "
+            f"{previa['TICKET'] or '-'} ({previa['FECHA']})."
+        )
+    return visible
+
+
+LECTORES = {"texto": leer_texto, "ubicacion": leer_ubicacion, "foto": leer_foto}
+
+
+# ================== DESPACHADORES ==================
+async def recibir_entrada(update: Update, context: ContextTypes.DEFAULT_TYPE, paso: str):
+    """Despachador común de los pasos de texto, ubicación y foto."""
+    if update.effective_chat.id in GRUPO_SUPERVISION_ID:
         return ConversationHandler.END  # ❌ Ignorar todo en el grupo supervisión
 
-    paso_cfg = PASOS[paso]
     registro = context.user_data["registro"]
-
-    # --- Validación según tipo ---
-    if paso_cfg["tipo"] == "texto":
-        if not update.message.text:
-            await update.message.reply_text("⚠️ Solo se acepta texto.")
-            return paso
-        registro[paso] = update.message.text
-
-    elif paso_cfg["tipo"] == "ubicacion":
-        if not update.message.location:
-            await update.message.reply_text("⚠️ Debe enviar una ubicación válida.")
-            return paso
-        registro[paso_cfg["lat_key"]] = update.message.location.latitude
-        registro[paso_cfg["lng_key"]] = update.message.location.longitude
-
-    elif paso_cfg["tipo"] == "foto":
-        if not update.message.photo:
-            await update.message.reply_text("⚠️ Debe enviar una foto.")
-            return paso
-        photo = update.message.photo[-1]
-        file = await photo.get_file()
-        file_bytes = await file.download_as_bytearray()
-        link = upload_to_drive(file_bytes, f"{paso}_{registro['ID_REGISTRO']}.jpg")
-        registro[paso] = link
+    try:
+        valor_visible = await LECTORES[PASOS[paso]["tipo"]](update, context, registro, paso)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return paso
+    registro.marcar_cambio()
 
     # ==================================================
     # 🔹 Caso especial: corrección desde RESUMEN FINAL
     # ==================================================
-    if registro.get("CORRIGIENDO") == paso:
-        registro.pop("CORRIGIENDO")
-        if registro.get("DESDE_RESUMEN", False):
-            registro.pop("DESDE_RESUMEN")
-            registro["PASO_ACTUAL"] = "RESUMEN_FINAL"
-            logger.info(f"✏️ Corrección de {paso} hecha desde RESUMEN FINAL.")
+    if registro.CORRIGIENDO == paso:
+        registro.CORRIGIENDO = None
+        if registro.DESDE_RESUMEN:
+            registro.DESDE_RESUMEN = False
+            registro.PASO_ACTUAL = "RESUMEN_FINAL"
+            logger.info("✏️ Corrección de %s hecha desde RESUMEN FINAL.", paso, extra=ctx_log(registro))
+            if PASOS[paso]["tipo"] == "foto":
+                # Los avisos de la subida (fotos ignoradas, posible repetida) no se pierden
+                await update.message.reply_text(f"📌 Has registrado {ETIQUETAS.get(paso, paso)}: {valor_visible}")
             return await mostrar_resumen_final(update, context)
 
     # ==================================================
     # 🔹 Flujo normal (NO corrección desde resumen)
     # ==================================================
-    keyboard = [
-        [InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
-         InlineKeyboardButton("✏️ Corregir", callback_data=f"CORREGIR_{paso}")]
-    ]
-
-    valor_visible = registro.get(paso, "")
-    if paso_cfg["tipo"] == "foto":
-        valor_visible = "📸 Foto recibida correctamente"
-    
     etiqueta = ETIQUETAS.get(paso, paso)
     await update.message.reply_text(
         f"📌 Has registrado {etiqueta}: {valor_visible}",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=TECLADO_CONFIRMAR[paso]
     )
 
-    registro["PASO_ACTUAL"] = paso
-    logger.info(f"📌 Paso actual actualizado a: {paso}")
+    registro.PASO_ACTUAL = paso
+    logger.info("📌 Paso actual actualizado a: %s", paso, extra=ctx_log(registro, muestreo=True))
     return "CONFIRMAR"
 
-# ================== CALLBACKS ==================
 
-async def tipo_caja_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Guarda el tipo de caja (CTO o NAP) seleccionado por el técnico"""
+async def acumular_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Junta las fotos de un álbum que llegan mientras se procesa la primera.
+
+    Si la tarea de leer_foto aún no empezó, el buffer del álbum se crea aquí.
+    Las fotos que llegan cuando el álbum ya se cerró (o sueltas) se avisan.
+    """
+    message = update.message
+    if not (message and message.photo):
+        return
+    albumes = context.user_data.setdefault("ALBUMES", {})
+    media_group_id = message.media_group_id
+    if media_group_id:
+        album = albumes.setdefault(media_group_id, {"FOTOS": [], "ABIERTO": True})
+        if album["ABIERTO"]:
+            album["FOTOS"].append(message.photo[-1])
+            return
+    await message.reply_text(
+        "⚠️ Esta foto llegó mientras se procesaban las anteriores y no se guardó.\n"
+        "👉 Si falta, corrígela desde el resumen final."
+    )
+
+
+async def esperar_subida(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Responde a todo lo demás (texto, /cancel, botones) mientras se suben las fotos.
+
+    En WAITING el ConversationHandler no revisa los fallbacks ni los otros
+    estados, así que sin esto esos mensajes se perderían sin respuesta.
+    """
+    if update.callback_query:
+        await update.callback_query.answer("⏳ Subiendo fotos, espera...")
+    elif update.effective_message:
+        await update.effective_message.reply_text("⏳ Subiendo fotos, espera a que termine y vuelve a intentarlo.")
+
+
+async def recibir_boton(update: Update, context: ContextTypes.DEFAULT_TYPE, paso: str):
+    """Despachador común de los pasos de botones (callback_data = "<PASO>:<VALOR>")."""
+    if update.effective_chat.id in GRUPO_SUPERVISION_ID:
+        return ConversationHandler.END  # ❌ Ignorar en grupo supervisión
+
     query = update.callback_query
-    await query.answer()
+    cfg = PASOS[paso]
+    # Botones enviados antes del cambio de formato siguen funcionando
+    valor = cfg.get("callback_anterior", {}).get(query.data) or query.data.split(":", 1)[-1]
+    if valor not in VALORES_BOTON[paso]:
+        await query.answer()
+        return paso
 
-    tipo = "CTO" if query.data == "TIPO_CTO" else "NAP"
     registro = context.user_data["registro"]
-    registro["TIPO_CAJA"] = tipo
+    setattr(registro, cfg["campo"], valor)
+    registro.marcar_cambio()
+    texto = cfg["texto_elegido"].format(cfg.get("visible", {}).get(valor, valor))
 
-    # ✅ Borramos mensaje anterior y mostramos confirmación con botones
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_TIPO_CAJA"),
-            InlineKeyboardButton("✏️ Corregir", callback_data=f"CORREGIR_TIPO_CAJA"),
-        ]
-    ]
-
-    texto_confirmacion = f"🟠 Has seleccionado: *{tipo}*"
-    await query.edit_message_text(
-        texto_confirmacion,
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    if not cfg.get("confirmar", True):
+        # Sin confirmación: se deja la respuesta a la vista y se avanza directo
+        await query.answer("⏳ Procesando...")
+        await editar_mensaje(query, texto)
+        return await avanzar(update, context, paso)
 
-    registro["PASO_ACTUAL"] = "TIPO_CAJA"
+    # ✅ Reemplazamos la botonera por la confirmación
+    await query.answer()
+    await editar_mensaje(query, texto, parse_mode="Markdown", reply_markup=TECLADO_CONFIRMAR[paso])
+    registro.PASO_ACTUAL = paso
     return "CONFIRMAR"
 
 
-# ================== CONFIRMAR CALLBACK ==================
-async def confirmar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    paso = query.data.replace("CONFIRMAR_", "")
+def siguiente_paso(registro, paso):
+    """Paso que sigue a `paso` según la tabla de transiciones y los saltos de botones."""
+    cfg = PASOS[paso]
+    siguiente = SIGUIENTE_PASO[paso]
+    if "saltos" in cfg:
+        siguiente = cfg["saltos"].get(getattr(registro, cfg["campo"]), siguiente)
+    return siguiente
+
+
+async def avanzar(update: Update, context: ContextTypes.DEFAULT_TYPE, paso: str):
+    """Pasa al siguiente paso según la tabla de transiciones (o al resumen final)."""
     registro = context.user_data["registro"]
-    valor = registro.get(paso, "")
+    siguiente = siguiente_paso(registro, paso)
 
-    etiqueta = ETIQUETAS.get(paso, paso)
-    await query.answer("⏳ Procesando...")
+    if siguiente == "RESUMEN_FINAL":
+        registro.PASO_ACTUAL = "RESUMEN_FINAL"
+        return await mostrar_resumen_final(update, context)
 
-    # ==========================================
-    # 🔹 MOSTRAR CONFIRMACIÓN SEGÚN TIPO DE PASO
-    # ==========================================
+    registro.PASO_ACTUAL = siguiente
+    return await pedir_paso(context.bot, update.effective_chat.id, siguiente)
 
-    if paso.startswith("FOTO_"):
-        try:
-            await query.edit_message_text(f"✅ {etiqueta} confirmado correctamente.")
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
 
-    elif paso.startswith("UBICACION_"):
-        lat = registro.get("LAT_CLIENTE" if paso == "UBICACION_CLIENTE" else "LAT_CTO")
-        lng = registro.get("LNG_CLIENTE" if paso == "UBICACION_CLIENTE" else "LNG_CTO")
-        try:
-            await query.edit_message_text(f"✅ {etiqueta} confirmado: ({lat}, {lng})")
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+# ================== CONFIRMAR CALLBACK ==================
+def _texto_confirmado(registro, paso):
+    cfg = PASOS[paso]
+    etiqueta = ETIQUETAS.get(paso, paso)
+    if cfg["tipo"] == "foto":
+        return f"✅ {etiqueta} confirmado correctamente.", {}
+    if cfg["tipo"] == "ubicacion":
+        return f"✅ {etiqueta} confirmado: ({getattr(registro, cfg['lat_key'])}, {getattr(registro, cfg['lng_key'])})", {}
+    if cfg["tipo"] == "boton":
+        valor = getattr(registro, cfg["campo"])
+        return cfg["texto_confirmado"].format(valor), {"parse_mode": "Markdown"}
+    return f"✅ {etiqueta} confirmado: {getattr(registro, paso, '')}", {}
 
-    elif paso == "TIPO_CAJA":
-        tipo = registro.get("TIPO_CAJA", "")
-        try:
-            await query.edit_message_text(f"✅ Tipo de caja confirmado: *{tipo}*", parse_mode="Markdown")
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
 
-    else:
-        try:
-            await query.edit_message_text(f"✅ {etiqueta} confirmado: {valor}")
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+async def confirmar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    paso = query.data.removeprefix("CONFIRMAR_")
+    registro = context.user_data["registro"]
+
+    await query.answer("⏳ Procesando...")
+    logger.info("✅ Paso %s confirmado", paso, extra=ctx_log(registro, muestreo=True))
+
+    texto, kwargs = _texto_confirmado(registro, paso)
+    await editar_mensaje(query, texto, **kwargs)
 
     # ======================================================
     # 🔹 SI LA CONFIRMACIÓN VIENE DESDE EL RESUMEN FINAL
     # ======================================================
-    if registro.get("DESDE_RESUMEN", False):
-        registro["CORRIGIENDO_ULTIMO"] = paso  # 👈 Campo corregido para resaltarlo
-        registro.pop("DESDE_RESUMEN", None)
-        registro.pop("CORRIGIENDO", None)
-        registro["PASO_ACTUAL"] = "RESUMEN_FINAL"
+    if registro.DESDE_RESUMEN:
+        registro.CORRIGIENDO_ULTIMO = paso  # 👈 Campo corregido para resaltarlo
+        registro.DESDE_RESUMEN = False
+        registro.CORRIGIENDO = None
+        registro.PASO_ACTUAL = "RESUMEN_FINAL"
 
         return await mostrar_resumen_final(update, context)
 
     # ======================================================
     # 🔹 FLUJO NORMAL (NO DESDE RESUMEN)
     # ======================================================
-    idx = PASOS_LISTA.index(paso)
-    if idx + 1 < len(PASOS_LISTA):
-        siguiente = PASOS_LISTA[idx + 1]
-        registro["PASO_ACTUAL"] = siguiente
-
-        if PASOS[siguiente]["tipo"] == "boton":
-            if siguiente == "TIPO_CAJA":
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🟦 CTO", callback_data="TIPO_CTO"),
-                        InlineKeyboardButton("🟩 NAP", callback_data="TIPO_NAP"),
-                    ]
-                ]
-                await context.bot.send_message(
-                    query.message.chat.id,
-                    PASOS[siguiente]["mensaje"],
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                return "TIPO_CAJA"
-
-            elif siguiente == "USO_SPLITTER":
-                keyboard = [[InlineKeyboardButton("✅ Confirmar", callback_data="SPLITTER_SI")]]
-                await context.bot.send_message(
-                    query.message.chat.id,
-                    PASOS[siguiente]["mensaje"],
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                return "USO_SPLITTER"
-
-        # Si el siguiente paso es texto, ubicación o foto
-        else:
-            await context.bot.send_message(query.message.chat.id, PASOS[siguiente]["mensaje"])
-            return siguiente
-
-    # Si no hay más pasos → mostrar resumen final
-    else:
-        return await mostrar_resumen_final(update, context)
+    return await avanzar(update, context, paso)
 
 
 async def corregir_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -492,102 +1458,154 @@ async def corregir_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END  # ❌ Ignorar en grupo supervisión
 
     query = update.callback_query
-    paso = query.data.replace("CORREGIR_", "")
+    paso = query.data.removeprefix("CORREGIR_")
     await query.answer("✏️ Corrigiendo...")
 
     # Guardamos el paso que quiere corregir
-    context.user_data["registro"]["CORRIGIENDO"] = paso
-
-    # 🔹 Si es el tipo de caja → mostrar nuevamente botonera CTO/NAP
-    if paso == "TIPO_CAJA":
-        keyboard = [
-            [
-                InlineKeyboardButton("🟦 CTO", callback_data="TIPO_CTO"),
-                InlineKeyboardButton("🟩 NAP", callback_data="TIPO_NAP"),
-            ]
-        ]
-        await query.edit_message_text(
-            "🟠 Seleccione nuevamente el tipo de caja:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return "TIPO_CAJA"
-
-    # 🔹 Para los demás pasos → mensaje estándar
-    mensaje = PASOS[paso]["mensaje"] if paso in PASOS else f"✏️ Ingresa el valor para {paso}:"
-    await query.edit_message_text(mensaje)
-
-    return paso
-
-
-async def uso_splitter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if chat_id in GRUPO_SUPERVISION_ID:
-        return ConversationHandler.END  # ❌ Ignorar en grupo supervisión
-
-    query = update.callback_query
-    await query.answer("⏳ Procesando...")
-
-    decision = "SI" if query.data == "SPLITTER_SI" else "NO"
-    context.user_data["registro"]["SPLITTER"] = decision
+    context.user_data["registro"].CORRIGIENDO = paso
+    return await pedir_correccion(query, paso)
+
+
+# ================== ESTADÍSTICAS ==================
+class EstadisticasRegistros:
+    """Agregados por día, técnico, tipo de caja y uso de splitter.
+
+    Viven en SQLite, un contador por (fecha, grupo, clave): guardar filas es un
+    UPSERT que suma en O(1) por fila, sin reescribir el histórico. SQLite
+    serializa las escrituras entre procesos, así el escritor, los workers y la
+    importación suman sobre el mismo archivo sin pisarse. La hoja solo se relee
+    al reconstruir, que reemplaza todo en una sola transacción.
+    """
+
+    _IDX_FECHA = ENCABEZADOS.index("FECHA")
+    _IDX_USER = ENCABEZADOS.index("USER_ID")
+    _IDX_TIPO = ENCABEZADOS.index("TIPO_CTO")  # la columna guarda TIPO_CAJA
+    _IDX_SPLITTER = ENCABEZADOS.index("SPLITTER")
+
+    def __init__(self, ruta):
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                " fecha TEXT, grupo TEXT, clave TEXT, n INTEGER NOT NULL,"
+                " PRIMARY KEY (fecha, grupo, clave))"
+            )
+
+    @staticmethod
+    def _dia_vacio():
+        return {"TOTAL": 0, "USUARIOS": {}, "TIPO_CAJA": {}, "SPLITTER": {}}
+
+    def _contar(self, filas):
+        conteo = {}
+        for fila in filas:
+            fecha = str(fila[self._IDX_FECHA])
+            for grupo, valor in (
+                ("TOTAL", ""),
+                ("USUARIOS", fila[self._IDX_USER]),
+                ("TIPO_CAJA", fila[self._IDX_TIPO] or "-"),
+                ("SPLITTER", fila[self._IDX_SPLITTER] or "NO"),
+            ):
+                clave = (fecha, grupo, str(valor))
+                conteo[clave] = conteo.get(clave, 0) + 1
+        return [(*clave, n) for clave, n in conteo.items()]
+
+    def registrar(self, filas):
+        """Suma las filas guardadas (I/O: correr fuera del event loop)."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO stats (fecha, grupo, clave, n) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (fecha, grupo, clave) DO UPDATE SET n = n + excluded.n",
+                self._contar(filas),
+            )
+
+    def reconstruir(self, filas):
+        """Recalcula todo desde las filas de la hoja (sin encabezado)."""
+        filas = [list(fila) + [""] * (len(ENCABEZADOS) - len(fila)) for fila in filas]
+        contadores = self._contar([fila for fila in filas if fila[self._IDX_FECHA]])
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM stats")
+            self._conn.executemany("INSERT INTO stats (fecha, grupo, clave, n) VALUES (?, ?, ?, ?)", contadores)
+
+    def del_dia(self, fecha):
+        with self._lock:
+            filas = self._conn.execute("SELECT grupo, clave, n FROM stats WHERE fecha = ?", (fecha,)).fetchall()
+        dia = self._dia_vacio()
+        for grupo, clave, n in filas:
+            if grupo == "TOTAL":
+                dia["TOTAL"] = n
+            else:
+                dia[grupo][clave] = n
+        return dia
+
+
+estadisticas = EstadisticasRegistros(STATS_PATH)
+
+
+async def escribir_filas(filas, destino=None):
+    """Agrega filas a su hoja destino y actualiza los agregados de /stats.
+
+    Sin `destino`, cada fila se enruta por su USER_ID (RUTAS_HOJAS).
+    """
+    por_destino = {}
+    for fila in filas:
+        nombre = destino or DESTINO_POR_USUARIO.get(str(fila[_IDX_USER_ID]), "principal")
+        por_destino.setdefault(nombre, []).append(fila)
+    await asyncio.gather(*(DESTINOS[nombre].escribir(grupo) for nombre, grupo in por_destino.items()))
+    try:
+        await asyncio.to_thread(estadisticas.registrar, filas)
+    except Exception as e:
+        # Las filas ya están en la hoja: esto no debe hacer fallar (y reintentar) el guardado
+        logger.error("❌ No se pudieron actualizar las estadísticas: %s", e)
 
-    # Editar el mensaje con respuesta clara y sin botones
-    texto = f"🔌 ¿Se confirmo el uso de splitter?: {'✅ Sí' if decision == 'SI' else '❌ No'}"
-    await query.edit_message_text(texto)
-
-    if decision == "SI":
-        # ✅ Guardamos el paso actual en el registro
-        context.user_data["registro"]["PASO_ACTUAL"] = "PUERTO"
-        await context.bot.send_message(query.message.chat.id, PASOS["PUERTO"]["mensaje"])
-        return "PUERTO"
-    else:
-        # ⚠️ Si no hay splitter, guardamos el estado como RESUMEN
-        context.user_data["registro"]["PASO_ACTUAL"] = "RESUMEN_FINAL"
-        return await mostrar_resumen_registro(update, context)
 
 # ================== GUARDAR EN SHEETS ==================
 async def guardar_registro(update, context):
     data = context.user_data["registro"]
     fecha, hora = get_fecha_hora()
-    data["FECHA"] = fecha
-    data["HORA"] = hora
-
-    fila = [
-        data.get("FECHA", ""), data.get("HORA", ""), data.get("USER_ID", ""), data.get("ID_REGISTRO", ""),
-        data.get("TICKET", ""), data.get("DNI", ""), data.get("NOMBRE", ""),
-        data.get("LAT_CLIENTE", ""), data.get("LNG_CLIENTE", ""),
-        data.get("TIPO_CAJA", ""),  # 👈 Nuevo valor
-        data.get("CODIGO_CTO", ""), data.get("LAT_CTO", ""), data.get("LNG_CTO", ""),
-        data.get("FOTO_CTO", ""),  # Link Drive
-        data.get("SPLITTER", "NO"),
-        data.get("PUERTO", ""),
-        data.get("FOTO_SPLITTER", "")
-    ]
-    worksheet.append_row(fila)
+    data.FECHA = fecha
+    data.HORA = hora
+
+    fila = construir_fila(data)
 
     # ✅ Resumen limpio
-    resumen_final = f"✅ *Registro guardado exitosamente*\n\n"
-    resumen_final += f"{ETIQUETAS['NOMBRE']}: {data.get('NOMBRE','')}\n"
-    resumen_final += f"{ETIQUETAS['TICKET']}: {data.get('TICKET','')}\n"
-    resumen_final += f"{ETIQUETAS['DNI']}: {data.get('DNI','')}\n"
-    # Coordenadas cliente
-    if data.get("LAT_CLIENTE") and data.get("LNG_CLIENTE"):
-        resumen_final += f"{ETIQUETAS['UBICACION_CLIENTE']}: ({data['LAT_CLIENTE']}, {data['LNG_CLIENTE']})\n"
-     # 👇 Aquí agregamos el tipo de caja (CTO o NAP)
-    resumen_final += f"{ETIQUETAS['TIPO_CAJA']}: {data.get('TIPO_CAJA','-')}\n"
-    # CTO
-    resumen_final += f"{ETIQUETAS['CODIGO_CTO']}: {data.get('CODIGO_CTO','')}\n"
-    if data.get("LAT_CTO") and data.get("LNG_CTO"):
-        resumen_final += f"{ETIQUETAS['UBICACION_CTO']}: ({data['LAT_CTO']}, {data['LNG_CTO']})\n"
-    # Splitter
-    resumen_final += f"{ETIQUETAS['SPLITTER']}: {data.get('SPLITTER','NO')} | {ETIQUETAS['PUERTO']}: {data.get('PUERTO','-')}\n"
-    # Fotos
-    fotos_txt = []
-    if data.get("FOTO_CTO"):
-        fotos_txt.append("CTO/NAP")
-    if data.get("FOTO_SPLITTER"):
-        fotos_txt.append("Splitter")
-    if fotos_txt:
-        resumen_final += f"📸 Fotos: {', '.join(fotos_txt)} guardadas correctamente\n"
+    resumen_final = render_resumen(data, ENCABEZADO_GUARDADO)
+    fotos = fotos_registro(data)
+
+    try:
+        if COLA_SALIDA is not None:
+            # 🧵 Modo workers: la fila y el aviso a supervisión los procesa el escritor
+            # compartido; se espera su confirmación antes de dar el registro por guardado
+            await enviar_a_escritor(
+                {"id": data.ID_REGISTRO, "fila": fila, "resumen": resumen_final, "fotos": fotos}
+            )
+        else:
+            await escribir_filas([fila])
+    except asyncio.TimeoutError:
+        # ⏳ El escritor no confirmó a tiempo, pero la fila sigue en su cola: al volver
+        # a guardar se reenvía con el mismo ID_REGISTRO y el escritor no la duplica
+        logger.warning("⏳ Guardado sin confirmar tras %s s", ESPERA_CONFIRMACION_SEG, extra=ctx_log(data))
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=(
+                "⏳ El guardado sigue pendiente (la hoja está lenta). Tus datos se conservan: "
+                "toca Guardar de nuevo en unos minutos para confirmarlo, no se duplicará."
+            )
+        )
+        return await mostrar_resumen_final(update, context)
+    except Exception as e:
+        # ❌ No se guardó: el registro se conserva para reintentar desde el resumen
+        logger.error("❌ No se pudo guardar el registro: %s", e, extra=ctx_log(data))
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="❌ No se pudo guardar el registro. Tus datos se conservan: intenta guardar de nuevo."
+        )
+        return await mostrar_resumen_final(update, context)
+    logger.info("💾 Registro guardado", extra=ctx_log(data))
+    await asyncio.to_thread(cache_fotos.asociar_ticket, data.TICKET, fotos)
+    await asyncio.to_thread(registrar_phashes, data)
+
     # 👤 Enviar al técnico
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -606,68 +1624,71 @@ async def guardar_registro(update, context):
     )
 
     # 📢 Enviar también al grupo de supervisión
-    for grupo_id in GRUPO_SUPERVISION_ID:
-        try:
-            await context.bot.send_message(chat_id=grupo_id, text=resumen_final, parse_mode="Markdown")
-
-            if data.get("FOTO_CTO"):
-                await context.bot.send_photo(chat_id=grupo_id, photo=data["FOTO_CTO"], caption="📸 CTO/NAP")
-            if data.get("FOTO_SPLITTER"):
-                await context.bot.send_photo(chat_id=grupo_id, photo=data["FOTO_SPLITTER"], caption="📸 Splitter")
-
-        except Exception as e:
-            logger.error(f"❌ Error enviando al grupo {grupo_id}: {e}")
+    if COLA_SALIDA is None:
+        await enviar_supervision(context.bot, resumen_final, fotos)
 
     # Limpiar completamente el registro al guardar
     context.user_data.pop("registro", None)
     return ConversationHandler.END
 
+
+async def enviar_supervision(bot, resumen_final, fotos):
+    """Envía el resumen y las fotos de un registro guardado a los grupos de supervisión."""
+    for grupo_id in GRUPO_SUPERVISION_ID:
+        try:
+            await bot.send_message(chat_id=grupo_id, text=resumen_final, parse_mode="Markdown")
+
+            for campo in PASOS_FOTO:
+                caption = f"📸 {PASOS[campo]['nombre']}"
+                links = fotos.get(campo, [])
+                if len(links) == 1:
+                    await bot.send_photo(chat_id=grupo_id, photo=links[0], caption=caption)
+                elif links:
+                    await bot.send_media_group(
+                        chat_id=grupo_id,
+                        media=[
+                            InputMediaPhoto(link, caption=caption if i == 0 else None)
+                            for i, link in enumerate(links)
+                        ]
+                    )
+
+        except Exception as e:
+            logger.error("❌ Error enviando al grupo %s: %s", grupo_id, e)
+
 # ================== MOSTRAR RESUMEN FINAL ==================
+# Botones de acción
+TECLADO_RESUMEN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Guardar Registro", callback_data="FINAL_GUARDAR")],
+    [InlineKeyboardButton("✏️ Corregir", callback_data="FINAL_CORREGIR")],
+    [InlineKeyboardButton("❌ Cancelar", callback_data="FINAL_CANCELAR")]
+])
+
 async def mostrar_resumen_final(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el resumen final del registro con opciones Guardar/Corregir/Cancelar"""
-    registro = context.user_data.get("registro", {})
-    paso_corregido = registro.get("CORRIGIENDO_ULTIMO", None)  # 👈 Campo corregido recientemente
+    registro = context.user_data["registro"]
+    paso_corregido = registro.CORRIGIENDO_ULTIMO  # 👈 Campo corregido recientemente
 
     # Texto base del resumen
-    resumen = (
-        f"📋 *Resumen del registro*\n\n"
-        f"🎫 Ticket: {registro.get('TICKET','')}\n"
-        f"🪪 DNI: {registro.get('DNI','')}\n"
-        f"👤 Cliente: {registro.get('NOMBRE','')}\n"
-        f"📍 Cliente: ({registro.get('LAT_CLIENTE','')}, {registro.get('LNG_CLIENTE','')})\n"
-        f"🟠 Tipo de caja: {registro.get('TIPO_CAJA','-')}\n"
-        f"🏷 CTO: {registro.get('CODIGO_CTO','')}\n"
-        f"📍 CTO: ({registro.get('LAT_CTO','')}, {registro.get('LNG_CTO','')})\n"
-        f"🔌 Splitter: {registro.get('SPLITTER','NO')} | Puerto: {registro.get('PUERTO','-')}\n"
-        f"📸 Fotos: {'✅' if registro.get('FOTO_CTO') else '❌'} CTO/NAP"
-        f"{'✅' if registro.get('FOTO_SPLITTER') else '❌'} Splitter"
-    )
+    resumen = render_resumen(registro)
 
     # ✏️ Si viene de corrección, añadir aviso visual arriba del resumen
     if paso_corregido:
         etiqueta = ETIQUETAS.get(paso_corregido, paso_corregido)
         resumen = f"✏️ *{etiqueta} actualizado correctamente.*\n\n" + resumen
-        registro.pop("CORRIGIENDO_ULTIMO", None)
-
-    # Botones de acción
-    keyboard = [
-        [InlineKeyboardButton("✅ Guardar Registro", callback_data="FINAL_GUARDAR")],
-        [InlineKeyboardButton("✏️ Corregir", callback_data="FINAL_CORREGIR")],
-        [InlineKeyboardButton("❌ Cancelar", callback_data="FINAL_CANCELAR")]
-    ]
+        registro.CORRIGIENDO_ULTIMO = None
 
     # Mostrar resumen reemplazando el mensaje anterior
     if update.callback_query:
         query = update.callback_query
         await query.edit_message_text(
             resumen,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=TECLADO_RESUMEN,
             parse_mode="Markdown"
         )
     else:
         await update.message.reply_text(
             resumen,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=TECLADO_RESUMEN,
             parse_mode="Markdown"
         )
 
@@ -687,23 +1708,10 @@ async def resumen_final_callback(update: Update, context: ContextTypes.DEFAULT_T
     elif accion == "FINAL_CORREGIR":
         await query.answer("✏️ Selecciona qué campo corregir")
 
-        # Botonera con todos los campos corregibles, incluyendo tipo de caja
-        keyboard = [
-            [InlineKeyboardButton("🎫 Ticket", callback_data="CORREGIR_TICKET"),
-             InlineKeyboardButton("🪪 DNI", callback_data="CORREGIR_DNI")],
-            [InlineKeyboardButton("👤 Nombre", callback_data="CORREGIR_NOMBRE"),
-             InlineKeyboardButton("📍 Cliente", callback_data="CORREGIR_UBICACION_CLIENTE")],
-            [InlineKeyboardButton("🟠 Tipo de caja", callback_data="CORREGIR_TIPO_CAJA"),
-             InlineKeyboardButton("🏷 CTO/NAP", callback_data="CORREGIR_CODIGO_CTO")],
-            [InlineKeyboardButton("📍 Ubicación CTO", callback_data="CORREGIR_UBICACION_CTO"),
-             InlineKeyboardButton("📸 Foto CTO", callback_data="CORREGIR_FOTO_CTO")],
-            [InlineKeyboardButton("🔌 Puerto", callback_data="CORREGIR_PUERTO"),
-             InlineKeyboardButton("📸 Foto Splitter", callback_data="CORREGIR_FOTO_SPLITTER")],
-        ]
-
+        # Botonera con todos los campos corregibles (generada desde PASOS)
         await query.edit_message_text(
             "✏️ Selecciona el campo que deseas corregir:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TECLADO_CORREGIR_CAMPO
         )
         return "CORREGIR_CAMPO"
 
@@ -718,44 +1726,119 @@ async def resumen_final_callback(update: Update, context: ContextTypes.DEFAULT_T
 async def corregir_campo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cuando selecciona qué campo corregir desde el resumen final"""
     query = update.callback_query
-    paso = query.data.replace("CORREGIR_", "")  # ej. CORREGIR_DNI → "DNI"
+    paso = query.data.removeprefix("CORREGIR_")  # ej. CORREGIR_DNI → "DNI"
 
     await query.answer("✏️ Corrigiendo...")
 
     # Guardamos el campo que se está corrigiendo
-    context.user_data["registro"]["CORRIGIENDO"] = paso
-    context.user_data["registro"]["DESDE_RESUMEN"] = True  # 👈 Marca que la corrección viene desde el resumen final
-
-    # 🔹 Caso especial: Tipo de caja (CTO o NAP)
-    if paso == "TIPO_CAJA":
-        keyboard = [
-            [
-                InlineKeyboardButton("🟦 CTO", callback_data="TIPO_CTO"),
-                InlineKeyboardButton("🟩 NAP", callback_data="TIPO_NAP"),
-            ]
-        ]
-        await query.edit_message_text(
-            "🟠 Seleccione nuevamente el tipo de caja:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return "TIPO_CAJA"
+    context.user_data["registro"].CORRIGIENDO = paso
+    context.user_data["registro"].DESDE_RESUMEN = True  # 👈 Marca que la corrección viene desde el resumen final
 
-    # 🔹 Para los demás pasos → mostrar su mensaje habitual
-    if paso in PASOS:
-        mensaje = PASOS[paso]["mensaje"]
-    else:
-        mensaje = f"✏️ Ingresa el valor para {ETIQUETAS.get(paso, paso)}:"
+    # 🔹 Actualizar el mensaje del resumen final → pedir el nuevo valor.
+    # 👉 Retorna el paso para que el manejador correcto capture la respuesta
+    return await pedir_correccion(query, paso)
 
-    # 🔹 Actualizar el mensaje del resumen final → pedir el nuevo valor
-    try:
-        await query.edit_message_text(mensaje)
-    except BadRequest as e:
-        if "Message is not modified" not in str(e):
-            raise
 
-    # 👉 Retorna el paso para que el manejador correcto capture la respuesta
-    return paso
+# ================== STATS ==================
+def es_supervision(update):
+    """Comandos de supervisión: solo en los grupos de supervisión o para USUARIOS_DEV."""
+    return update.effective_chat.id in GRUPO_SUPERVISION_ID or update.effective_user.id in USUARIOS_DEV
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats [AAAA-MM-DD | reconstruir] — resumen del día para supervisión."""
+    if not es_supervision(update):
+        return
+
+    if context.args and context.args[0].lower() == "reconstruir":
+        await update.message.reply_text("⏳ Reconstruyendo estadísticas desde la hoja...")
+        filas = await asyncio.to_thread(leer_todas_las_hojas)
+        await asyncio.to_thread(estadisticas.reconstruir, filas)
+        await update.message.reply_text(f"✅ Estadísticas reconstruidas ({len(filas)} filas).")
+        return
 
+    fecha = context.args[0] if context.args else get_fecha_hora()[0]
+    dia = await asyncio.to_thread(estadisticas.del_dia, fecha)
+    tipos = dia["TIPO_CAJA"]
+    por_tecnico = sorted(dia["USUARIOS"].items(), key=lambda item: item[1], reverse=True)
+
+    texto = (
+        f"📊 *Estadísticas {escapar_md(fecha)}*\n\n"
+        f"🧾 Registros: {dia['TOTAL']}\n"
+        f"🔌 Con splitter: {dia['SPLITTER'].get('SI', 0)}\n"
+        f"🟦 CTO: {tipos.get('CTO', 0)} | 🟩 NAP: {tipos.get('NAP', 0)}\n"
+    )
+    if por_tecnico:
+        texto += "\n👷 Por técnico:\n" + "\n".join(f"• {escapar_md(uid)}: {n}" for uid, n in por_tecnico)
+    await update.message.reply_text(texto, parse_mode="Markdown")
+
+# ================== VER FOTOS ==================
+def fotos_ticket_en_hojas(ticket):
+    """{paso: [links]} de un ticket buscado en las hojas (registros que no pasaron por la cache)."""
+    idx_ticket = ENCABEZADOS.index("TICKET")
+    columnas = [(i, campo) for i, (_, campo) in enumerate(COLUMNAS_HOJA) if campo in PASOS_FOTO]
+    fotos = {}
+    for fila in leer_todas_las_hojas():
+        if len(fila) <= idx_ticket or fila[idx_ticket].strip() != ticket:
+            continue
+        for i, paso in columnas:
+            links = fila[i].splitlines() if i < len(fila) else []
+            fotos.setdefault(paso, []).extend(link.strip() for link in links if "id=" in link)
+    return fotos
+
+
+async def ver(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ver <TICKET> — fotos de un ticket desde la cache local (Drive solo si faltan)."""
+    if not es_supervision(update):
+        return
+    if not context.args:
+        await update.message.reply_text("👉 Uso: /ver <TICKET>")
+        return
+
+    ticket = " ".join(context.args).strip()
+    fotos = await asyncio.to_thread(cache_fotos.fotos_ticket, ticket)
+    if not fotos:
+        # Registros anteriores a la cache, de otra máquina o importados: se buscan en la hoja
+        try:
+            por_paso = await asyncio.to_thread(fotos_ticket_en_hojas, ticket)
+        except Exception as e:
+            logger.error("❌ Error buscando el ticket %s en las hojas: %s", ticket, e)
+            await update.message.reply_text("❌ No se pudo consultar la hoja, intenta de nuevo.")
+            return
+        await asyncio.to_thread(cache_fotos.asociar_ticket, ticket, por_paso)
+        fotos = [(paso, file_id_de_link(link)) for paso, links in por_paso.items() for link in links]
+    if not fotos:
+        await update.message.reply_text(f"🔎 No hay fotos registradas para el ticket {ticket}.")
+        return
+
+    async def obtener(file_id):
+        file_bytes = await asyncio.to_thread(cache_fotos.leer, file_id)
+        if file_bytes is None:
+            try:
+                file_bytes = await google_async.files_get_media(file_id)
+            except Exception as e:
+                logger.error("❌ Error descargando %s de Drive: %s", file_id, e)
+                return None
+            await asyncio.to_thread(cache_fotos.guardar, file_bytes, file_id)
+        return file_bytes
+
+    contenidos = await asyncio.gather(*(obtener(file_id) for _, file_id in fotos))
+    media = [
+        InputMediaPhoto(file_bytes, caption=f"{ETIQUETAS.get(paso, paso)} · {ticket}")
+        for (paso, _), file_bytes in zip(fotos, contenidos) if file_bytes is not None
+    ]
+    fallidas = len(fotos) - len(media)
+    if fallidas:
+        await update.message.reply_text(f"⚠️ No se pudieron descargar {fallidas} de {len(fotos)} fotos de Drive.")
+    # Telegram acepta álbumes de 2 a 10 fotos
+    for i in range(0, len(media), 10):
+        grupo = media[i:i + 10]
+        if len(grupo) == 1:
+            await context.bot.send_photo(
+                chat_id=update.effective_chat.id, photo=grupo[0].media, caption=grupo[0].caption
+            )
+        else:
+            await context.bot.send_media_group(chat_id=update.effective_chat.id, media=grupo)
 
 # ================== CANCEL ==================
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -763,155 +1846,329 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Registro cancelado.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
-#============= RESUMEN REGISTRO ==============
-
-async def mostrar_resumen_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = context.user_data["registro"]
-
-    resumen = (
-        f"📋 *Resumen del registro*\n\n"
-        f"👤 Cliente: {data.get('NOMBRE','')}\n"
-        f"🎫 Ticket: {data.get('TICKET','')}\n"
-        f"🪪 DNI: {data.get('DNI','')}\n"
-        f"📍 Cliente: {data.get('LAT_CLIENTE','')}, {data.get('LNG_CLIENTE','')}\n"
-        f"🟠 Tipo de Caja: {data.get('TIPO_CAJA','-')}\n"  # 👈 NUEVA LÍNEA AÑADIDA
-        f"🏷 CTO/NAP: {data.get('CODIGO_CTO','')}\n"
-        f"📍 CTO/NAP: {data.get('LAT_CTO','')}, {data.get('LNG_CTO','')}\n"
-        f"🔌 Splitter: {data.get('SPLITTER','NO')} | Puerto: {data.get('PUERTO','-')}\n"
-        f"📸 Fotos registradas correctamente."
-    )
+# ================== IMPORTACIÓN HISTÓRICA ==================
+# Encabezados alternativos aceptados en los archivos históricos
+ALIAS_COLUMNAS = {
+    **{paso: cfg["campo"] for paso, cfg in PASOS.items() if cfg.get("campo", paso) != paso},
+    **{cfg["columna"]: cfg.get("campo", paso) for paso, cfg in PASOS.items() if "columna" in cfg},
+}
 
-    # Botonera final
-    keyboard = [
-        [InlineKeyboardButton("✅ Guardar registro", callback_data="FINAL_GUARDAR")],
-        [InlineKeyboardButton("✏️ Corregir dato", callback_data="FINAL_CORREGIR")],
-        [InlineKeyboardButton("❌ Cancelar", callback_data="FINAL_CANCELAR")]
-    ]
 
-    # 👉 Igual: editar mensaje si existe callback_query
-    if update.callback_query:
-        await update.callback_query.edit_message_text(
-            resumen,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+def _normalizar_columna(nombre):
+    clave = str(nombre or "").strip().upper().replace(" ", "_")
+    return ALIAS_COLUMNAS.get(clave, clave)
+
+
+def _texto_celda(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, datetime):
+        return valor.strftime("%Y-%m-%d")
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))  # Excel guarda DNI/puertos como números
+    return str(valor).strip()
+
+
+def leer_historico(ruta, lote):
+    """Genera lotes de filas (dicts por columna normalizada) sin cargar el archivo entero."""
+    if ruta.lower().endswith((".xlsx", ".xlsm")):
+        # Dependencias pesadas: solo se importan al usar el CLI
+        from openpyxl import load_workbook
+        libro = load_workbook(ruta, read_only=True, data_only=True)
+        filas = libro.active.iter_rows(values_only=True)
+        columnas = [_normalizar_columna(c) for c in next(filas, [])]
+        bloque = []
+        for valores in filas:
+            bloque.append({c: _texto_celda(v) for c, v in zip(columnas, valores)})
+            if len(bloque) >= lote:
+                yield bloque
+                bloque = []
+        if bloque:
+            yield bloque
+        libro.close()
     else:
-        await update.message.reply_text(
-            resumen,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        import pandas as pd
+        for chunk in pd.read_csv(ruta, chunksize=lote, dtype=str, keep_default_na=False):
+            chunk.columns = [_normalizar_columna(c) for c in chunk.columns]
+            yield [{c: _texto_celda(v) for c, v in fila.items()} for fila in chunk.to_dict("records")]
 
-    return "RESUMEN_FINAL"
 
-# ================== MAIN ==================
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def _ruta_foto(foto, carpeta_base):
+    return foto if os.path.isabs(foto) else os.path.join(carpeta_base, foto)
 
-    conv_handler = ConversationHandler(
-        entry_points=[
-            CommandHandler("start", start),
-            CommandHandler("registro", registro)
-        ],
-        states={
 
-            # ====== PASO 1: TICKET ======
-            "TICKET": [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "TICKET")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+def validar_historico(datos, carpeta_base="."):
+    """Aplica a una fila importada las mismas reglas de los PASOS del bot.
 
-            # ====== PASO 2: DNI ======
-            "DNI": [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "DNI")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+    Los pasos que el bot no pediría (por los saltos de un paso de botones, p. ej.
+    sin splitter) pueden venir vacíos. Devuelve la fila normalizada y la lista
+    de errores encontrados.
+    """
+    errores = []
+    registro = Registro(
+        FECHA=datos.get("FECHA", ""),
+        HORA=datos.get("HORA", ""),
+        USER_ID=datos.get("USER_ID", ""),
+        ID_REGISTRO=datos.get("ID_REGISTRO") or str(uuid.uuid4())[:8],
+    )
+    if not registro.FECHA:
+        errores.append("FECHA vacía")
+
+    siguiente = PASOS_LISTA[0]  # se recorre el flujo como lo haría el bot
+    for paso, cfg in PASOS.items():
+        error = None
+        if cfg["tipo"] == "texto":
+            try:
+                setattr(registro, paso, VALIDADORES[paso](datos.get(paso)))
+            except ValueError:
+                error = f"{paso} vacío"
+
+        elif cfg["tipo"] == "ubicacion":
+            try:
+                lat, lng = VALIDADORES[paso]((datos.get(cfg["lat_key"]), datos.get(cfg["lng_key"])))
+                setattr(registro, cfg["lat_key"], lat)
+                setattr(registro, cfg["lng_key"], lng)
+            except ValueError:
+                error = f"{paso} inválida"
+
+        elif cfg["tipo"] == "boton":
+            campo = cfg["campo"]
+            valor = (datos.get(campo) or cfg.get("por_defecto", "")).upper()
+            setattr(registro, campo, valor)
+            if valor not in VALORES_BOTON[paso]:
+                error = f"{campo} debe ser {' o '.join(sorted(VALORES_BOTON[paso]))}"
+
+        elif cfg["tipo"] == "foto":
+            fotos = [f.strip() for f in datos.get(paso, "").replace(";", "\n").splitlines() if f.strip()]
+            if not fotos:
+                error = f"{paso} vacío"
+            for foto in fotos:
+                if not foto.startswith("http") and not os.path.isfile(_ruta_foto(foto, carpeta_base)):
+                    errores.append(f"{paso}: no existe {foto}")
+            setattr(registro, paso, fotos)
+
+        if paso == siguiente:
+            if error:
+                errores.append(error)
+            siguiente = siguiente_paso(registro, paso)
+
+    return registro, errores
+
+
+async def _subir_fotos_locales(registro, carpeta_base, limite):
+    """Sube a Drive las fotos referenciadas como archivos locales; los links se dejan igual."""
+    async def subir(paso, i, ruta):
+        async with limite:
+            with open(ruta, "rb") as f:
+                file_bytes = await asyncio.to_thread(f.read)
+            link = await upload_to_drive(file_bytes, f"{paso}_{registro.ID_REGISTRO}_{i}.jpg")
+            await indexar_foto(file_bytes, registro, paso, link)
+            return link
+
+    for paso in PASOS_FOTO:
+        tareas = []
+        for i, foto in enumerate(getattr(registro, paso), start=1):
+            if foto.startswith("http"):
+                tareas.append(asyncio.sleep(0, result=foto))
+            else:
+                tareas.append(subir(paso, i, _ruta_foto(foto, carpeta_base)))
+        setattr(registro, paso, list(await asyncio.gather(*tareas)))
+
+
+def _id_importado(ruta, numero_fila):
+    """ID_REGISTRO estable para filas sin ID: el mismo en cada reintento de la importación."""
+    return hashlib.sha1(f"{os.path.basename(ruta)}:{numero_fila}".encode()).hexdigest()[:8]
+
+
+def _ids_en_hojas():
+    """ID_REGISTRO de todas las filas ya escritas en las hojas destino."""
+    return {fila[_IDX_ID_REGISTRO] for fila in leer_todas_las_hojas() if len(fila) > _IDX_ID_REGISTRO}
+
+
+def _guardar_checkpoint(ruta, datos):
+    tmp = f"{ruta}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(datos, f)
+    os.replace(tmp, ruta)
+
+
+async def importar_historico(ruta, checkpoint=None, lote=IMPORT_LOTE):
+    """Carga registros históricos (CSV/Excel) en la hoja, en lotes y de forma reanudable.
+
+    Antes de escribir un lote se marca en el checkpoint como "en_curso"; si la
+    importación se corta a mitad del lote, al reanudar se omiten las filas cuyo
+    ID_REGISTRO ya está en las hojas (sin volver a escribirlas ni subir sus fotos).
+    """
+    ruta = os.path.abspath(ruta)
+    checkpoint = checkpoint or f"{ruta}.checkpoint.json"
+    rechazos_path = f"{ruta}.rechazadas.csv"
+    carpeta_base = os.path.dirname(ruta)
+
+    avance = {
+        "archivo": ruta, "filas_procesadas": 0, "filas_escritas": 0, "filas_rechazadas": 0, "en_curso": None
+    }
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            avance.update(json.load(f))
+        logger.info("↩️ Reanudando importación desde la fila %s", avance["filas_procesadas"])
 
-            # ====== PASO 3: NOMBRE ======
-            "NOMBRE": [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "NOMBRE")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+    limite = asyncio.Semaphore(IMPORT_SUBIDAS_PARALELAS)
+    saltar = avance["filas_procesadas"]
+    ultima_escritura = 0.0
+    loop = asyncio.get_running_loop()
 
-            # ====== PASO 4: UBICACIÓN CLIENTE ======
-            "UBICACION_CLIENTE": [
-                MessageHandler(filters.LOCATION, lambda u, c: manejar_paso(u, c, "UBICACION_CLIENTE")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+    try:
+        for bloque in leer_historico(ruta, lote):
+            if saltar >= len(bloque):
+                saltar -= len(bloque)
+                continue
+            bloque, saltar = bloque[saltar:], 0
+
+            validos, rechazados, regiones = [], [], {}
+            for numero, datos in enumerate(bloque, start=avance["filas_procesadas"]):
+                if not datos.get("ID_REGISTRO"):
+                    datos["ID_REGISTRO"] = _id_importado(ruta, numero)
+                registro, errores = validar_historico(datos, carpeta_base)
+                region = datos.get("REGION") or None  # columna opcional → hoja destino
+                if region and region not in DESTINOS:
+                    errores.append(f"REGION desconocida: {region}")
+                if errores:
+                    rechazados.append({**datos, "ERRORES": "; ".join(errores)})
+                else:
+                    validos.append((region, registro))
+
+            omitidos = 0
+            if avance["en_curso"] == avance["filas_procesadas"]:
+                # ↩️ Este lote se cortó a mitad: no repetir las filas que ya llegaron a la hoja
+                ya_escritos = await asyncio.to_thread(_ids_en_hojas)
+                omitidos = sum(r.ID_REGISTRO in ya_escritos for _, r in validos)
+                validos = [(region, r) for region, r in validos if r.ID_REGISTRO not in ya_escritos]
+                logger.info("↩️ %s filas del lote interrumpido ya estaban en la hoja", omitidos)
+            elif rechazados:
+                # (en un lote reanudado ya se escribieron antes de marcarlo en curso)
+                nuevo = not os.path.exists(rechazos_path)
+                with open(rechazos_path, "a", newline="") as f:
+                    escritor = csv.DictWriter(f, fieldnames=list(rechazados[0].keys()), extrasaction="ignore")
+                    if nuevo:
+                        escritor.writeheader()
+                    escritor.writerows(rechazados)
+
+            avance["en_curso"] = avance["filas_procesadas"]
+            _guardar_checkpoint(checkpoint, avance)
+
+            for region, registro in validos:
+                regiones.setdefault(region, []).append(registro)
+            validos = [registro for _, registro in validos]
+            await asyncio.gather(*(_subir_fotos_locales(r, carpeta_base, limite) for r in validos))
+
+            if validos:
+                # ⏱ Respetar la cuota de escritura de Sheets
+                espera = ultima_escritura + IMPORT_INTERVALO_SEG - loop.time()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                for region, registros in regiones.items():
+                    await escribir_filas([construir_fila(r) for r in registros], destino=region)
+                for r in validos:
+                    await asyncio.to_thread(cache_fotos.asociar_ticket, r.TICKET, fotos_registro(r))
+                    await asyncio.to_thread(registrar_phashes, r)
+                ultima_escritura = loop.time()
+
+            avance["filas_procesadas"] += len(bloque)
+            avance["filas_escritas"] += len(validos) + omitidos
+            avance["filas_rechazadas"] += len(rechazados)
+            avance["en_curso"] = None
+            _guardar_checkpoint(checkpoint, avance)
+            logger.info(
+                "📥 Importadas %s filas (%s rechazadas)",
+                avance["filas_escritas"], avance["filas_rechazadas"]
+            )
+    finally:
+        await google_async.aclose()
+
+    logger.info("✅ Importación terminada: %s", avance)
+    return avance
 
-            # ====== PASO 5: TIPO DE CAJA (CTO/NAP) ======
-            "TIPO_CAJA": [
-                CallbackQueryHandler(tipo_caja_callback, pattern="^(TIPO_CTO|TIPO_NAP)$"),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
 
-            # ====== PASO 6: CÓDIGO CTO/NAP ======
-            "CODIGO_CTO": [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "CODIGO_CTO")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+# ================== MAIN ==================
+async def cerrar_clientes(app):
+    """Cierra el pool HTTP de Google al detener el bot."""
+    await google_async.aclose()
 
-            # ====== PASO 7: UBICACIÓN CTO ======
-            "UBICACION_CTO": [
-                MessageHandler(filters.LOCATION, lambda u, c: manejar_paso(u, c, "UBICACION_CTO")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
 
-            # ====== PASO 8: FOTO CTO ======
-            "FOTO_CTO": [
-                MessageHandler(filters.PHOTO, lambda u, c: manejar_paso(u, c, "FOTO_CTO")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+# Comandos que se atienden en cualquier estado de la conversación
+COMANDOS_EN_CURSO = [CommandHandler("start", start), CommandHandler("registro", registro)]
 
-            # ====== PASO 9: USO DE SPLITTER ======
-            "USO_SPLITTER": [
-                CallbackQueryHandler(uso_splitter_callback, pattern="^(SPLITTER_SI)$"),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+# Filtro y despachador por tipo de paso
+FILTRO_POR_TIPO = {
+    "texto": filters.TEXT & ~filters.COMMAND,
+    "ubicacion": filters.LOCATION,
+    "foto": filters.PHOTO,
+}
 
-            # ====== PASO 10: PUERTO ======
-            "PUERTO": [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "PUERTO")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
 
-            # ====== PASO 11: FOTO SPLITTER ======
-            "FOTO_SPLITTER": [
-                MessageHandler(filters.PHOTO, lambda u, c: manejar_paso(u, c, "FOTO_SPLITTER")),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
-            ],
+def estados_pasos():
+    """Un estado por paso de PASOS, con el despachador de su tipo de entrada."""
+    estados = {}
+    for paso, cfg in PASOS.items():
+        if cfg["tipo"] == "boton":
+            anteriores = "".join(f"|{data}$" for data in cfg.get("callback_anterior", {}))
+            handler = CallbackQueryHandler(
+                functools.partial(recibir_boton, paso=paso), pattern=f"^({paso}:{anteriores})"
+            )
+        else:
+            # Las fotos no bloquean: las demás fotos de un álbum llegan a WAITING
+            opciones = {"block": False} if cfg["tipo"] == "foto" else {}
+            handler = MessageHandler(
+                FILTRO_POR_TIPO[cfg["tipo"]], functools.partial(recibir_entrada, paso=paso), **opciones
+            )
+        estados[paso] = [handler, *COMANDOS_EN_CURSO]
+    return estados
+
+
+def construir_app(con_updater=True):
+    """Arma la Application con el ConversationHandler completo.
+
+    Con con_updater=False no hace polling propio: los updates se inyectan en
+    app.update_queue (modo workers).
+    """
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_shutdown(cerrar_clientes)
+    if not con_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("start", start),
+            CommandHandler("registro", registro)
+        ],
+        states={
+            # ====== PASOS DEL REGISTRO (generados desde PASOS) ======
+            **estados_pasos(),
 
             # ====== PASO DE CONFIRMACIÓN GENERAL ======
             "CONFIRMAR": [
                 CallbackQueryHandler(confirmar_callback, pattern="^CONFIRMAR_.*$"),
                 CallbackQueryHandler(corregir_callback, pattern="^CORREGIR_.*$"),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
+                *COMANDOS_EN_CURSO,
             ],
 
             # ====== RESUMEN FINAL ======
             "RESUMEN_FINAL": [
                 CallbackQueryHandler(resumen_final_callback, pattern="^FINAL_.*$"),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
+                *COMANDOS_EN_CURSO,
+            ],
+
+            # ====== MIENTRAS SE SUBEN FOTOS (resto del álbum y aviso de espera) ======
+            ConversationHandler.WAITING: [
+                MessageHandler(filters.PHOTO, acumular_album),
+                MessageHandler(filters.ALL, esperar_subida),
+                CallbackQueryHandler(esperar_subida),
             ],
 
             # ====== CORRECCIÓN DESDE RESUMEN ======
             "CORREGIR_CAMPO": [
                 CallbackQueryHandler(corregir_campo_callback, pattern="^CORREGIR_.*$"),
-                CommandHandler("start", start),
-                CommandHandler("registro", registro),
+                *COMANDOS_EN_CURSO,
             ],
         },
 
@@ -919,6 +2176,244 @@ def main():
     )
 
     app.add_handler(conv_handler)
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("ver", ver))
+    return app
+
+
+# ================== MODO WORKERS ==================
+# Un proceso "frente" hace polling y reparte cada update al worker
+# user_id % N, así cada conversación (context.user_data) vive siempre en el
+# mismo proceso. Cada worker importa este módulo de cero (spawn) y tiene sus
+# propios clientes de Google. Las filas guardadas y los avisos a supervisión
+# pasan por una cola compartida hacia un único proceso escritor, que agrupa
+# las filas en llamadas a values.append y confirma cada una al worker que la
+# envió (cola de respuestas propia de cada worker, por ID_REGISTRO). Un
+# reenvío del mismo ID_REGISTRO se confirma sin duplicar la fila, y los avisos
+# a supervisión salen desde una tarea aparte para no demorar las escrituras.
+COLA_SALIDA = None  # multiprocessing.Queue hacia el escritor (solo en workers)
+WORKER_INDICE = None
+_CONFIRMACIONES = {}  # ID_REGISTRO → future que resuelve la respuesta del escritor
+
+
+async def enviar_a_escritor(item):
+    """Encola una fila para el escritor y espera su confirmación.
+
+    Lanza RuntimeError si no se guardó y asyncio.TimeoutError si no hubo
+    respuesta a tiempo (la fila puede guardarse igual más tarde).
+    """
+    listo = asyncio.get_running_loop().create_future()
+    _CONFIRMACIONES[item["id"]] = listo
+    try:
+        COLA_SALIDA.put({**item, "worker": WORKER_INDICE})
+        error = await asyncio.wait_for(listo, ESPERA_CONFIRMACION_SEG)
+    finally:
+        _CONFIRMACIONES.pop(item["id"], None)
+    if error:
+        raise RuntimeError(error)
+
+
+async def _recibir_confirmaciones(cola_respuestas):
+    """Resuelve las esperas de enviar_a_escritor con las respuestas del escritor."""
+    while True:
+        respuesta = await asyncio.to_thread(cola_respuestas.get)
+        if respuesta is None:
+            break
+        listo = _CONFIRMACIONES.get(respuesta["id"])
+        if listo is not None and not listo.done():
+            listo.set_result(respuesta["error"])
+
+
+async def _frente_polling(colas):
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.delete_webhook()
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES
+                    )
+                except Exception as e:
+                    logger.error("❌ Error en get_updates: %s", e)
+                    await asyncio.sleep(2)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    user = update.effective_user
+                    shard = user.id % len(colas) if user else 0
+                    colas[shard].put(update.to_dict())
+        finally:
+            if offset is not None:
+                # Telegram solo da por recibidos los updates al pedir el siguiente offset:
+                # sin esto, el último lote repartido se vuelve a entregar al reiniciar
+                try:
+                    await bot.get_updates(offset=offset, timeout=0, limit=1)
+                except Exception as e:
+                    logger.warning("⚠️ No se pudo confirmar el offset %s a Telegram: %s", offset, e)
+
+
+async def _worker(indice, cola_updates, cola_respuestas):
+    confirmaciones = asyncio.create_task(_recibir_confirmaciones(cola_respuestas))
+    app = construir_app(con_updater=False)
+    async with app:
+        await app.start()
+        logger.info("🧵 Worker %s listo", indice)
+        while True:
+            data = await asyncio.to_thread(cola_updates.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await app.stop()  # espera a los handlers en curso (y a sus confirmaciones)
+    cola_respuestas.put(None)
+    await confirmaciones
+    await cerrar_clientes(app)
+
+
+def _proceso_worker(indice, cola_updates, cola_salida, cola_respuestas):
+    global COLA_SALIDA, WORKER_INDICE
+    COLA_SALIDA = cola_salida
+    WORKER_INDICE = indice
+    # El frente coordina el apagado (SIGINT de Ctrl+C, SIGTERM de Heroku)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker(indice, cola_updates, cola_respuestas))
+
+
+async def _supervisar(bot, cola):
+    """Envía a supervisión los registros ya guardados, aparte del ciclo de escritura.
+
+    Los límites de Telegram por grupo pueden frenar estos envíos; así no
+    demoran las escrituras ni las confirmaciones a los workers.
+    """
+    while True:
+        item = await cola.get()
+        if item is None:
+            break
+        await enviar_supervision(bot, item["resumen"], item["fotos"])
+
+
+async def _escritor(cola_salida, colas_respuesta):
+    async with Bot(BOT_TOKEN) as bot:
+        cola_supervision = asyncio.Queue()
+        supervision = asyncio.create_task(_supervisar(bot, cola_supervision))
+        # ID_REGISTRO ya escritos (los más recientes): un reenvío tras un timeout
+        # del worker se confirma sin volver a agregar la fila
+        guardados = {}
+        fin = False
+        while not fin:
+            lote = [await asyncio.to_thread(cola_salida.get)]
+            while len(lote) < LOTE_ESCRITURA_MAX:
+                try:
+                    lote.append(cola_salida.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lote:
+                fin = True
+                lote = [item for item in lote if item is not None]
+            if not lote:
+                continue
+
+            nuevos = {}
+            for item in lote:
+                if item["id"] in guardados or item["id"] in nuevos:
+                    logger.info("↩️ Fila de %s reenviada: ya estaba guardada o en este lote", item["id"])
+                else:
+                    nuevos[item["id"]] = item
+
+            # Cada fila se confirma por separado; DestinoHoja igual las agrupa en
+            # un solo values.append por hoja porque llegan juntas a su cola
+            resultados = await asyncio.gather(
+                *(escribir_filas([item["fila"]]) for item in nuevos.values()), return_exceptions=True
+            )
+            errores = {}
+            for item, resultado in zip(nuevos.values(), resultados):
+                error = None
+                if isinstance(resultado, BaseException):
+                    error = str(resultado) or repr(resultado)
+                    logger.error("❌ Error guardando la fila de %s: %s", item["id"], error)
+                else:
+                    guardados[item["id"]] = True
+                    cola_supervision.put_nowait(item)
+                errores[item["id"]] = error
+            for item in lote:
+                colas_respuesta[item["worker"]].put({"id": item["id"], "error": errores.get(item["id"])})
+
+            while len(guardados) > IDS_GUARDADOS_MAX:
+                del guardados[next(iter(guardados))]
+
+        cola_supervision.put_nowait(None)
+        await supervision
+    await google_async.aclose()
+
+
+def _proceso_escritor(cola_salida, colas_respuesta):
+    # Drena la cola hasta recibir None (lo envía el frente al apagar)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_escritor(cola_salida, colas_respuesta))
+
+
+def ejecutar_workers(n):
+    """Levanta el escritor y N workers, y hace de frente de polling en este proceso."""
+    ctx = multiprocessing.get_context("spawn")
+    cola_salida = ctx.Queue()
+    colas = [ctx.Queue() for _ in range(n)]
+    respuestas = [ctx.Queue() for _ in range(n)]
+    escritor = ctx.Process(target=_proceso_escritor, args=(cola_salida, respuestas), name="escritor")
+    workers = [
+        ctx.Process(target=_proceso_worker, args=(i, colas[i], cola_salida, respuestas[i]), name=f"worker-{i}")
+        for i in range(n)
+    ]
+    escritor.start()
+    for proceso in workers:
+        proceso.start()
+
+    # SIGTERM (reinicio de Heroku) apaga igual que Ctrl+C: se drenan las colas
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info("🤖 Bot iniciado con %s workers y escuchando...", n)
+    try:
+        asyncio.run(_frente_polling(colas))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Heroku manda SIGKILL a los 30 s del SIGTERM
+        for cola in colas:
+            cola.put(None)
+        for proceso in workers:
+            proceso.join(timeout=10)
+        cola_salida.put(None)
+        escritor.join(timeout=15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot de registro de splitters")
+    comandos = parser.add_subparsers(dest="comando")
+    importar = comandos.add_parser("importar", help="Carga registros históricos desde Excel/CSV")
+    importar.add_argument("archivo", help="Archivo .csv o .xlsx con las columnas de ENCABEZADOS")
+    importar.add_argument("--checkpoint", help="Archivo de avance (por defecto <archivo>.checkpoint.json)")
+    importar.add_argument("--lote", type=int, default=IMPORT_LOTE, help="Filas por escritura")
+    exportar = comandos.add_parser("exportar", help="Exporta a CSV la vista combinada de todas las hojas")
+    exportar.add_argument("archivo", help="Archivo .csv de salida")
+    args = parser.parse_args()
+    preparar_hojas()
+
+    if args.comando == "importar":
+        asyncio.run(importar_historico(args.archivo, args.checkpoint, args.lote))
+        return
+
+    if args.comando == "exportar":
+        with open(args.archivo, "w", newline="") as f:
+            escritor = csv.writer(f)
+            escritor.writerow(ENCABEZADOS)
+            escritor.writerows(leer_todas_las_hojas())
+        return
+
+    if BOT_WORKERS > 1:
+        ejecutar_workers(BOT_WORKERS)
+        return
+
+    app = construir_app()
     logger.info("🤖 Bot iniciado y escuchando...")
     app.run_polling()
 